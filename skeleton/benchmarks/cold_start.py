@@ -0,0 +1,108 @@
+from argparse import ArgumentParser
+from json import dumps
+from os import environ, pathsep
+from os.path import abspath, dirname, join
+from statistics import median
+from subprocess import DEVNULL, PIPE, Popen, run
+from sys import executable
+from time import perf_counter, sleep
+from typing import Dict, List, Optional
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
+
+# Run from anywhere, e.g. python benchmarks/cold_start.py --runs 5
+#  The serving app is started with the current environment, so set MLFLOW_TRACKING_URI (and USE_SERVING_RUNTIME)
+#  to a tracking server with an Active model for /health to ever succeed, or pass --any-status to time until the first response.
+PROJECT_DIR = dirname(dirname(abspath(__file__)))
+SERVING_DIR = join(PROJECT_DIR, "serving")
+
+
+def serving_env() -> Dict[str, str]:
+    env = dict(environ)
+    env["PYTHONPATH"] = pathsep.join([PROJECT_DIR] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+    return env
+
+
+def profile_imports(top: int) -> Dict:
+    """
+    Profiles the imports of the serving app with python -X importtime.
+
+    Args:
+        top (int): How many modules to report, ordered by cumulative import time.
+    """
+    result = run([executable, "-X", "importtime", "-c", "import app"], cwd=SERVING_DIR, env=serving_env(), stdout=DEVNULL, stderr=PIPE, text=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules.append({"module": name.strip(), "self_ms": int(self_us) / 1000, "cumulative_ms": int(cumulative_us) / 1000})
+
+    app_import = next((module for module in modules if module["module"] == "app"), None)
+    return {
+        "total_ms": app_import["cumulative_ms"] if app_import else None,
+        "slowest_modules": sorted(modules, key=lambda module: module["cumulative_ms"], reverse=True)[:top]
+    }
+
+
+def _wait_for_health(process: Popen, port: int, any_status: bool, timeout: float) -> Optional[float]:
+    start = perf_counter()
+    # Stop early if the app fails to start, e.g. if it can't reach MLflow.
+    while perf_counter() - start < timeout and process.poll() is None:
+        try:
+            with urlopen(f"http://127.0.0.1:{port}/health", timeout=1):
+                return perf_counter()
+        except HTTPError:
+            if any_status:
+                return perf_counter()
+        except (URLError, ConnectionError):
+            pass
+        sleep(0.01)
+    return None
+
+
+def measure_cold_start(port: int, any_status: bool, timeout: float) -> Optional[float]:
+    """
+    Starts the serving app and measures the seconds from process start to the first successful /health.
+
+    Args:
+        port (int): The port to start the app on.
+        any_status (bool): Whether to stop at the first response to /health even if it is unhealthy.
+        timeout (float): How many seconds to wait for /health before giving up.
+    """
+    start = perf_counter()
+    process = Popen([executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port)],
+                    cwd=SERVING_DIR, env=serving_env(), stdout=DEVNULL, stderr=DEVNULL)
+    try:
+        healthy_at = _wait_for_health(process, port, any_status, timeout)
+    finally:
+        process.terminate()
+        process.wait()
+    return None if healthy_at is None else healthy_at - start
+
+
+def main():
+    parser = ArgumentParser(description="Profiles the imports and cold start of the serving app.")
+    parser.add_argument("--runs", type=int, default=5, help="How many times to start the app.")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--top", type=int, default=15, help="How many of the slowest imports to report.")
+    parser.add_argument("--timeout", type=float, default=120.)
+    parser.add_argument("--any-status", action="store_true", help="Stop at the first response to /health, even if it is unhealthy.")
+    args = parser.parse_args()
+
+    cold_starts: List[Optional[float]] = [measure_cold_start(args.port, args.any_status, args.timeout) for _ in range(args.runs)]
+    successful = [x for x in cold_starts if x is not None]
+    report = {
+        "imports": profile_imports(args.top),
+        "cold_start_seconds": {
+            "runs": cold_starts,
+            "failed": len(cold_starts) - len(successful),
+            "median": median(successful) if successful else None,
+            "max": max(successful) if successful else None
+        }
+    }
+    print(dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
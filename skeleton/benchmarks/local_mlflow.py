@@ -0,0 +1,53 @@
+from argparse import ArgumentParser
+from os.path import abspath, dirname
+from sys import path
+from typing import List, Optional, Sequence
+
+path.insert(0, dirname(dirname(abspath(__file__))))
+
+from common import MODEL_NAME, MODEL_VERSION
+from common.mlflow_api import save_model, list_runs, update_active_runs
+from common.model_status import ModelStatus
+
+# Fills a local MLflow file store with Active runs for the serving app to load, e.g. file:///tmp/mlruns.
+#  The runs hold constant models, which are enough to exercise everything around the model.
+
+
+def seed_tracking_store(tracking_uri: str, submodel_names: Sequence[Optional[str]] = (None,), prediction: float = 0.5) -> List[str]:
+    """
+    Saves one constant model per submodel and makes them all Active with an equal test fraction.
+
+    Args:
+        tracking_uri (str): The MLflow tracking URI to save the runs to.
+        submodel_names (Sequence[Optional[str]]): The submodels to create. None uses the name of the experiment.
+        prediction (float): What every model predicts.
+
+    Returns:
+        The ids of the new runs.
+    """
+    import mlflow
+    import mlflow.sklearn
+    from sklearn.dummy import DummyRegressor
+
+    mlflow.set_tracking_uri(tracking_uri)
+    for submodel_name in submodel_names:
+        model = DummyRegressor(strategy="constant", constant=prediction).fit([[0.]], [prediction])
+        save_model(model, MODEL_VERSION, mlflow.sklearn, experiment_name=MODEL_NAME, submodel_name=submodel_name)
+
+    run_ids = list(list_runs(MODEL_VERSION, experiment_name=MODEL_NAME, active_state=ModelStatus.New).run_id)
+    update_active_runs({run_id: 1. for run_id in run_ids}, MODEL_VERSION, experiment_name=MODEL_NAME, use_serving_runtime=False)
+    return run_ids
+
+
+def main():
+    parser = ArgumentParser(description="Fills a local MLflow file store with Active runs for the serving app.")
+    parser.add_argument("tracking_uri", help="e.g. file:///tmp/mlruns")
+    parser.add_argument("--submodel", action="append", dest="submodel_names", help="A submodel to create. Can be repeated.")
+    args = parser.parse_args()
+
+    for run_id in seed_tracking_store(args.tracking_uri, args.submodel_names or [None]):
+        print(run_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from http.client import HTTPConnection
+from json import dump, dumps, load
+from math import ceil
+from subprocess import DEVNULL, Popen
+from sys import executable, exit, stdout
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from time import perf_counter, sleep
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+from cold_start import SERVING_DIR, serving_env
+from local_mlflow import seed_tracking_store
+from stub_inference_server import start_stub_server
+
+# Runs the serving app against a local MLflow file store and a stub ModelMesh, puts it under concurrent load, and reports
+#  the throughput and latency percentiles of each scenario as JSON, e.g.:
+#  python benchmarks/run_benchmarks.py --output results.json
+#  python benchmarks/run_benchmarks.py --baseline results.json  # Exits with 1 if anything regressed.
+PERCENTILES = (50, 95, 99)
+
+
+class LoadSpec(NamedTuple):
+    name: str
+    method: str
+    path: str
+    concurrency: int
+    body: Optional[bytes] = None
+    # Waits between the requests of each client. Otherwise, each client sends its next request as soon as it gets an answer.
+    interval: float = 0.
+
+
+def _percentile(sorted_values: List[float], percentile: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    return sorted_values[max(ceil(percentile / 100 * len(sorted_values)) - 1, 0)]
+
+
+def _summarize(latencies: List[float], status_counts: Dict[str, int], duration: float) -> Dict:
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "status_counts": status_counts,
+        "throughput_rps": len(latencies) / duration,
+        "latency_ms": {
+            **{f"p{percentile}": _percentile(latencies, percentile) for percentile in PERCENTILES},
+            "max": latencies[-1] if latencies else None
+        }
+    }
+
+
+def _run_client(port: int, spec: LoadSpec, stop: Event, latencies: List[float], status_counts: Dict[str, int]):
+    # One connection per client, kept alive like a real caller's would be.
+    connection = HTTPConnection("127.0.0.1", port, timeout=60)
+    headers = {"Content-Type": "application/json"} if spec.body is not None else {}
+    while not stop.is_set():
+        start = perf_counter()
+        try:
+            connection.request(spec.method, spec.path, body=spec.body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            status = str(response.status)
+        except (OSError, ConnectionError):
+            connection.close()
+            status = "error"
+        latencies.append((perf_counter() - start) * 1000)
+        status_counts[status] = status_counts.get(status, 0) + 1
+        if spec.interval:
+            stop.wait(spec.interval)
+    connection.close()
+
+
+def run_load(port: int, specs: List[LoadSpec], duration: float) -> Dict[str, Dict]:
+    """
+    Sends every kind of request in specs at the same time for a fixed duration.
+
+    Args:
+        port (int): The port of the serving app.
+        specs (List[LoadSpec]): The requests to send and how many clients send each of them.
+        duration (float): How many seconds to send requests for.
+
+    Returns:
+        The throughput, latency percentiles and status codes of each kind of request, by name.
+    """
+    stop = Event()
+    results = {spec.name: ([], {}) for spec in specs}
+    clients = [Thread(target=_run_client, args=(port, spec, stop, *results[spec.name]))
+               for spec in specs for _ in range(spec.concurrency)]
+    start = perf_counter()
+    for client in clients:
+        client.start()
+    sleep(duration)
+    stop.set()
+    for client in clients:
+        client.join()
+    elapsed = perf_counter() - start
+    return {name: _summarize(latencies, status_counts, elapsed) for name, (latencies, status_counts) in results.items()}
+
+
+def _wait_until_ready(process: Popen, port: int, timeout: float):
+    start = perf_counter()
+    while perf_counter() - start < timeout and process.poll() is None:
+        try:
+            connection = HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/readyz")
+            if connection.getresponse().status == 200:
+                return
+        except (OSError, ConnectionError):
+            pass
+        sleep(0.1)
+    raise RuntimeError("The serving app did not become ready.")
+
+
+@contextmanager
+def serving_app(port: int, workers: int, extra_env: Dict[str, str]) -> Iterator[int]:
+    env = {**serving_env(), **extra_env}
+    if workers > 1:
+        env["SERVING_WORKERS"] = str(workers)
+        command = [executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "-b", f"127.0.0.1:{port}", "app:app"]
+    else:
+        command = [executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port)]
+    process = Popen(command, cwd=SERVING_DIR, env=env, stdout=DEVNULL, stderr=DEVNULL)
+    try:
+        _wait_until_ready(process, port, timeout=120)
+        yield port
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def find_regressions(report: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """
+    Compares the p99 latency and throughput of every request in report against baseline.
+
+    Args:
+        report (Dict): The results of this run.
+        baseline (Dict): The results of an earlier run to compare with.
+        tolerance (float): How much worse than the baseline a result may be, as a fraction.
+    """
+    regressions = []
+    for scenario, results in report["scenarios"].items():
+        for name, result in results.items():
+            previous = baseline.get("scenarios", {}).get(scenario, {}).get(name)
+            if not previous:
+                continue
+            if result["latency_ms"]["p99"] is not None and previous["latency_ms"]["p99"] is not None \
+                    and result["latency_ms"]["p99"] > previous["latency_ms"]["p99"] * (1 + tolerance):
+                regressions.append(f"{scenario}/{name}: p99 went from {previous['latency_ms']['p99']:.2f}ms to {result['latency_ms']['p99']:.2f}ms")
+            if result["throughput_rps"] < previous["throughput_rps"] * (1 - tolerance):
+                regressions.append(f"{scenario}/{name}: throughput went from {previous['throughput_rps']:.1f}rps to {result['throughput_rps']:.1f}rps")
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description="Load tests the serving app against local stand-ins for MLflow and ModelMesh.")
+    parser.add_argument("--backend", choices=["runtime", "local"], default="runtime",
+                        help="Whether the app calls the stub serving runtime or loads the models into memory.")
+    parser.add_argument("--workers", type=int, default=1, help="More than 1 serves the app with gunicorn.")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10., help="Seconds per scenario.")
+    parser.add_argument("--payload", default="{}", help="The JSON body to send to /predict.")
+    parser.add_argument("--submodels", type=int, default=1, help="How many submodels to make Active.")
+    parser.add_argument("--stub-latency-ms", type=float, default=5.)
+    parser.add_argument("--cache-ttl", type=int, default=4, help="The cache TTL, in seconds, for the cache expiry scenario.")
+    parser.add_argument("--reload-interval", type=float, default=0.2, help="Seconds between reloads of each client in the reload storm.")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--stub-port", type=int, default=8008)
+    parser.add_argument("--output", help="Writes the report to this file as well as to stdout.")
+    parser.add_argument("--baseline", help="An earlier report to compare with.")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    payload = args.payload.encode()
+    predict = LoadSpec("predict", "POST", "/predict", args.concurrency, payload)
+
+    with TemporaryDirectory() as tracking_dir:
+        tracking_uri = f"file://{tracking_dir}"
+        seed_tracking_store(tracking_uri, [None] + [f"submodel-{i}" for i in range(1, args.submodels)])
+        stub = start_stub_server(args.stub_port, args.stub_latency_ms)
+        env = {
+            "MLFLOW_TRACKING_URI": tracking_uri,
+            "USE_SERVING_RUNTIME": str(args.backend == "runtime"),
+            "MODELMESH_URL": f"http://127.0.0.1:{args.stub_port}",
+            "ENSEMBLE_MODE": str(args.submodels > 1)
+        }
+
+        scenarios = dict()
+        try:
+            with serving_app(args.port, args.workers, env) as port:
+                scenarios["predict"] = run_load(port, [predict], args.duration)
+                scenarios["health"] = run_load(port, [LoadSpec("health", "GET", "/health", args.concurrency)], args.duration)
+                scenarios["reload_storm"] = run_load(port, [
+                    predict,
+                    LoadSpec("reload_models", "PUT", "/reload_models", max(args.concurrency // 4, 1), interval=args.reload_interval)
+                ], args.duration)
+
+            # The models expire and are reloaded several times while this runs.
+            with serving_app(args.port, args.workers, {**env, "CACHE_TTL": str(args.cache_ttl)}) as port:
+                scenarios["cache_expiry"] = run_load(port, [predict], max(args.duration, 3 * args.cache_ttl))
+        finally:
+            stub.shutdown()
+
+    report = {"config": vars(args), "scenarios": scenarios}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            report["regressions"] = find_regressions(report, load(baseline_file), args.tolerance)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            dump(report, output_file, indent=2)
+    stdout.write(dumps(report, indent=2) + "\n")
+
+    if report.get("regressions"):
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
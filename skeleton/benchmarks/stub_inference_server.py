@@ -0,0 +1,78 @@
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps, loads
+from threading import Thread
+from time import sleep
+
+# A stand-in for ModelMesh that speaks just enough of the KServe v2 inference protocol for common.serving_runtime.predict.
+#  Every model answers every row with the same prediction after a fixed latency.
+PREDICTION = 0.5
+
+
+class StubInferenceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency_seconds = 0.0
+
+    def _respond(self, status: int, body: dict):
+        content = dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path in ("/v2/health/live", "/v2/health/ready"):
+            self._respond(200, {})
+        else:
+            self._respond(404, {"error": f"{self.path} not found"})
+
+    def do_POST(self):
+        request = loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 4 or parts[:2] != ["v2", "models"] or parts[3] != "infer":
+            self._respond(404, {"error": f"{self.path} not found"})
+            return
+
+        sleep(self.latency_seconds)
+        rows = request["inputs"][0]["shape"][0]
+        self._respond(200, {
+            "model_name": parts[2],
+            "outputs": [{"name": "predict", "shape": [rows], "datatype": "FP32", "data": [PREDICTION] * rows}]
+        })
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _build_server(port: int, latency_ms: float) -> ThreadingHTTPServer:
+    handler = type("ConfiguredStubInferenceHandler", (StubInferenceHandler,), {"latency_seconds": latency_ms / 1000})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_stub_server(port: int, latency_ms: float = 0.) -> ThreadingHTTPServer:
+    """
+    Starts the stub inference server on a background thread. Call shutdown() on the result to stop it.
+
+    Args:
+        port (int): The port to listen on.
+        latency_ms (float): How long each inference takes.
+    """
+    server = _build_server(port, latency_ms)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = ArgumentParser(description="Runs a stub KServe v2 inference server.")
+    parser.add_argument("--port", type=int, default=8008)
+    parser.add_argument("--latency-ms", type=float, default=0.)
+    args = parser.parse_args()
+
+    _build_server(args.port, args.latency_ms).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
-from os import getenv
+from math import ceil
+from os import getenv, sched_getaffinity
 
 def _strtobool (val):
     """
@@ -18,8 +19,28 @@ def _strtobool (val):
         raise ValueError("invalid truth value %r" % (val,))
 
 
+def available_cores() -> int:
+    """
+    Counts the cores this process can use. This honours the CPU limit of the container (cgroup v2 or v1),
+    which a plain CPU count doesn't: in a pod, that returns the cores of the whole node.
+    """
+    cores = len(sched_getaffinity(0))
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as cpu_max:
+            quota, period = cpu_max.read().split()
+    except OSError:
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as cfs_quota, open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as cfs_period:
+                quota, period = cfs_quota.read().strip(), cfs_period.read().strip()
+        except OSError:
+            return cores
+    if quota in ("max", "-1"):
+        return cores
+    return max(1, min(cores, ceil(int(quota) / int(period))))
+
+
 MODEL_NAME = "{{ cookiecutter.project_name }}"
 MODEL_VERSION = "0.0.1"
 USE_SERVING_RUNTIME = _strtobool(getenv("USE_SERVING_RUNTIME") or "False")
 
-CACHE_TTL = 600
\ No newline at end of file
+CACHE_TTL = int(getenv("CACHE_TTL") or 600)
\ No newline at end of file
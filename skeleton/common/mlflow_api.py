@@ -1,17 +1,23 @@
-from typing import Tuple, Optional, Dict, Union, Sequence, Any, Set
+from packaging.version import parse
+from tempfile import TemporaryDirectory
+from typing import TYPE_CHECKING, Tuple, Optional, Dict, Union, Sequence, Any, Set
 
-import mlflow.pyfunc
-from mlflow.entities import Run, Experiment
-from pandas import DataFrame, Series
-from pkg_resources import packaging
+from pandas import DataFrame, Series, notna
 
 from common import MODEL_NAME, USE_SERVING_RUNTIME
 from common.model_status import ModelStatus
+from common.onnx_export import export_onnx
+from common.pipeline import PIPELINE_FILE_NAME, Pipeline
 from common.serving_runtime import add_model, remove_model
 
+# mlflow is imported in the functions that use it, since it is slow to import and the serving app doesn't need it until it loads its models.
+#  mlflow.pyfunc is only imported when a model is saved or loaded, so it is never imported if the models are in a serving runtime.
+if TYPE_CHECKING:
+    from mlflow.entities import Run, Experiment
+
 
 def _parse_semver(version: str) -> Tuple[str, str, str]:
-    x = packaging.version.parse(version)
+    x = parse(version)
     return x.major, x.minor, x.micro
 
 
@@ -31,6 +37,14 @@ def _adjust_runtime_path_for_bucket(artifact_uri: str) -> str:
     return return_path
 
 
+def _get_runtime_model_path(run: Series) -> str:
+    # Runs exported to ONNX record which of their artifacts the serving runtime should load.
+    path = _adjust_runtime_path_for_bucket(run.artifact_uri)
+    if notna(run.get("params.onnx_artifact")):
+        path = path + "/" + run["params.onnx_artifact"]
+    return path
+
+
 def save_model(model,
                model_version: Union[str, Tuple[str, str, str]],
                mlflow_subpackage=None,
@@ -38,7 +52,13 @@ def save_model(model,
                experiment_name: Optional[str] = None,
                submodel_name: Optional[str] = None,
                immutable_metadata: Dict[str, str] = {},
-               mutable_metadata: Dict[str, float] = {}):
+               mutable_metadata: Dict[str, float] = {},
+               onnx_sample_data: Optional[DataFrame] = None,
+               quantize_onnx: bool = False,
+               pipeline: Optional[Pipeline] = None,
+               onnx_rtol: float = 1e-3,
+               onnx_atol: float = 1e-4,
+               parent_run_id: Optional[str] = None) -> str:
     """
     Saves a model in MLFlow.
 
@@ -51,7 +71,18 @@ def save_model(model,
         submodel_name (Optional[str]): Submodel name if you have one. If not provided, uses the name of the experiment.
         immutable_metadata (Dict[str, str]): Any additional metadata inherent to the model or model process that you want to keep track of.
         mutable_metadata (Dict[str, float]): Any additional metadata specific to the model that can change over time.
+        onnx_sample_data (Optional[DataFrame]): A preprocessed sample batch. If provided, the model is also exported to ONNX, checked against the original on this batch, and the ONNX model is what the serving runtime loads.
+        quantize_onnx (bool): Whether to also export a dynamically quantised int8 ONNX model, which is served instead if it is accurate enough and smaller or faster.
+        pipeline (Optional[Pipeline]): The fitted pipeline the model was trained with. It is saved as JSON next to the model and loaded back with it.
+        onnx_rtol (float): The error allowed between the ONNX model and the original, relative to each prediction.
+        onnx_atol (float): The absolute error allowed on top of onnx_rtol.
+        parent_run_id (Optional[str]): The run to nest this one under, e.g. the run of the search it is a candidate of (see start_parent_run).
+
+    Returns:
+        The id of the new run.
     """
+    import mlflow.pyfunc
+
     if experiment_id is None and experiment_name is None:
         raise ValueError("Experiment Id or Experiment Name must be set")
     if experiment_id is not None:
@@ -68,7 +99,7 @@ def save_model(model,
     if type(model_version) == str:
         model_version = _parse_semver(model_version)
 
-    with mlflow.start_run():
+    with mlflow.start_run(parent_run_id=parent_run_id) as run:
         mlflow.log_param("submodel_name", submodel_name)
         mlflow.log_param("major_version", model_version[0])
         mlflow.log_param("minor_version", model_version[1])
@@ -82,8 +113,71 @@ def save_model(model,
         if mutable_metadata:
             mlflow.log_metrics(mutable_metadata)
 
+        if onnx_sample_data is not None:
+            # A failed parity check fails the run, so it can never be listed or served.
+            with TemporaryDirectory() as onnx_dir:
+                serving_file, onnx_metrics = export_onnx(model, onnx_sample_data, onnx_dir, quantize_onnx, onnx_rtol, onnx_atol)
+                mlflow.log_artifacts(onnx_dir, "onnx")
+            mlflow.log_param("onnx_artifact", "onnx/" + serving_file)
+            mlflow.log_metrics(onnx_metrics)
+
+        if pipeline is not None:
+            mlflow.log_dict(pipeline.to_dict(), PIPELINE_FILE_NAME)
+            mlflow.log_param("pipeline_artifact", PIPELINE_FILE_NAME)
+
         mlflow_subpackage.log_model(model, "", registered_model_name=submodel_name)
 
+    return run.info.run_id
+
+
+def start_parent_run(experiment_id: Optional[str] = None,
+                     experiment_name: Optional[str] = None,
+                     immutable_metadata: Dict[str, str] = {}) -> str:
+    """
+    Creates a run with no model to nest other runs under, e.g. the candidates of a hyperparameter search.
+    It has no model version, so it is never listed as a model. Record its outcome with log_to_run once the nested runs are done.
+
+    Args:
+        experiment_id (Optional[str]): Experiment Id if known. Optional with the experiment name.
+        experiment_name (Optional[str]): Experiment Name if known. Optional with the experiment id.
+        immutable_metadata (Dict[str, str]): Any metadata to describe the nested runs by.
+
+    Returns:
+        The id of the new run.
+    """
+    import mlflow
+
+    if experiment_id is None and experiment_name is None:
+        raise ValueError("Experiment Id or Experiment Name must be set")
+    if experiment_id is not None:
+        mlflow.set_experiment(experiment_id=experiment_id)
+    else:
+        mlflow.set_experiment(experiment_name=experiment_name)
+
+    # The run is ended straight away, so that it isn't the active run of whatever starts the nested runs.
+    with mlflow.start_run() as run:
+        if immutable_metadata:
+            mlflow.log_params(immutable_metadata)
+    return run.info.run_id
+
+
+def log_to_run(run_id: str, immutable_metadata: Dict[str, str] = {}, mutable_metadata: Dict[str, float] = {}):
+    """
+    Adds metadata to an existing run.
+
+    Args:
+        run_id (str): The id of the run.
+        immutable_metadata (Dict[str, str]): Metadata to log as parameters, which can't be changed once logged.
+        mutable_metadata (Dict[str, float]): Metadata to log as metrics.
+    """
+    import mlflow
+
+    with mlflow.start_run(run_id):
+        if immutable_metadata:
+            mlflow.log_params(immutable_metadata)
+        if mutable_metadata:
+            mlflow.log_metrics(mutable_metadata)
+
 
 def change_status(run_id: str, new_active_state: Optional[ModelStatus], new_test_fraction: Optional[float]):
     """
@@ -94,6 +188,8 @@ def change_status(run_id: str, new_active_state: Optional[ModelStatus], new_test
         new_active_state (Optional[ModelStatus]): The new production status.
         new_test_fraction (Optional[float]): The A/B test fraction.
     """
+    import mlflow
+
     run = mlflow.get_run(run_id)
     with mlflow.start_run(run.info.run_id):
         if new_active_state:
@@ -161,7 +257,7 @@ def update_active_runs(test_fraction_by_run: Dict[str, float],
                        submodel_name: Optional[str] = None,
                        extra_immutable_metadata: Dict[str, str] = {},
                        extra_mutable_metadata: Dict[str, float] = {},
-                       use_serving_runtime: bool = USE_SERVING_RUNTIME) -> Sequence[Run]:
+                       use_serving_runtime: bool = USE_SERVING_RUNTIME) -> Sequence["Run"]:
     """
     Updates which runs are active and in which test fraction.
 
@@ -205,7 +301,7 @@ def update_active_runs(test_fraction_by_run: Dict[str, float],
         else:
             change_status(run_to_update, ModelStatus.Active, test_fraction_by_run[run_to_update])
             if use_serving_runtime:
-                add_model(run_to_update, _adjust_runtime_path_for_bucket(run_information[run_to_update].artifact_uri))
+                add_model(run_to_update, _get_runtime_model_path(run_information[run_to_update]))
 
 
 
@@ -249,7 +345,7 @@ def change_test_fractions(test_fraction_by_run: Dict[str, float],
         else:
             change_status(run_to_update, ModelStatus(run_dict[run_to_update]['metrics.active_state']), test_fraction_by_run[run_to_update])
             if use_serving_runtime:
-                add_model(run_to_update.run_id, _adjust_runtime_path_for_bucket(run_to_update.artifact_uri))
+                add_model(run_to_update, _get_runtime_model_path(run_dict[run_to_update]))
 
 
 def list_runs(model_version: Union[str, Tuple[str, str, str]],
@@ -271,10 +367,12 @@ def list_runs(model_version: Union[str, Tuple[str, str, str]],
         extra_immutable_metadata (Dict[str, str]): Any additional metadata inherent to the model or model process that you want to keep track of.
         extra_mutable_metadata (Dict[str, float]): Any additional metadata specific to the model that can change over time.
     """
+    import mlflow
+
     if experiment_id is None and experiment_name is None:
         raise ValueError("Experiment Id or Experiment Name must be set.")
 
-    experiment: Optional[Experiment] = None
+    experiment: Optional["Experiment"] = None
     if experiment_id is not None:
         experiment = mlflow.get_experiment(experiment_id)
     else:
@@ -308,10 +406,23 @@ def list_runs(model_version: Union[str, Tuple[str, str, str]],
 
 def load_single_model(run: Series,
                       mlflow_subpackage=None) -> Any:
+    if mlflow_subpackage is None:
+        import mlflow.pyfunc
+        mlflow_subpackage = mlflow.pyfunc
+
     filepath = run.artifact_uri
     return mlflow_subpackage.load_model(filepath)
 
 
+def load_single_pipeline(run: Series) -> Optional[Pipeline]:
+    # Runs saved without a pipeline, including any from before pipelines existed, have nothing to load.
+    if not notna(run.get("params.pipeline_artifact")):
+        return None
+    import mlflow.artifacts
+
+    return Pipeline.from_dict(mlflow.artifacts.load_dict(run.artifact_uri + "/" + run["params.pipeline_artifact"]))
+
+
 def list_models(model_version: Union[str, Tuple[str, str, str]],
                 mlflow_subpackage=None,
                 experiment_id: Optional[str] = None,
@@ -342,9 +453,6 @@ def list_models(model_version: Union[str, Tuple[str, str, str]],
 
     models = []
 
-    if mlflow_subpackage is None:
-        mlflow_subpackage = mlflow.pyfunc
-
     for _, run in runs.iterrows():
         models.append(load_single_model(run, mlflow_subpackage))
 
@@ -378,10 +486,9 @@ def list_models_with_metadata(model_version: Union[str, Tuple[str, str, str]],
 
     models = dict()
 
-    if mlflow_subpackage is None:
-        mlflow_subpackage = mlflow.pyfunc
-
     for _, run in runs.iterrows():
+        # The pipeline is needed in both cases, since the features are always computed by this process.
+        run["pipeline"] = load_single_pipeline(run)
         if use_serving_runtime:
             models[run.run_id] = run
         else:
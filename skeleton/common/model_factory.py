@@ -1,17 +1,49 @@
 from cachetools import TTLCache
+from math import isclose
+from os import getenv
+from pandas import DataFrame, Series
+from time import time
 from typing import Dict, Tuple, Sequence, Union, Optional, Any
 
 from common.mlflow_api import (
     save_model as save_to_mlflow,
+    list_runs,
     list_models,
-    list_models_with_metadata
+    list_models_with_metadata,
+    load_single_model,
+    load_single_pipeline,
+    log_to_run,
+    start_parent_run,
+    _rebalance_test_fractions
 )
 from common.model_status import ModelStatus
+from common.pipeline import Pipeline
 from common import MODEL_NAME, MODEL_VERSION, USE_SERVING_RUNTIME, CACHE_TTL
 
 # The cache will default to 10 minutes, but you can change this as needed.
 _model_cache = TTLCache(maxsize=10, ttl=CACHE_TTL)
 
+# Set by freeze_models when several serving workers share one copy of the models. It doesn't expire like the cache does.
+_frozen_models: Optional[Dict[str, Union[Sequence, Tuple[Sequence, Sequence]]]] = None
+
+# When the active models were last loaded and why the last attempt failed, if it did. This lets health checks report
+#  on the models without loading them.
+_model_load_state: Dict[str, Any] = {"loaded_at": None, "error": None}
+
+# The mlflow flavor your model is logged with, e.g. mlflow.sklearn. If left as None, models are saved and loaded with mlflow.pyfunc.
+#  Incremental training needs the native flavor so that the saved model can be loaded back with its partial_fit or warm_start.
+_mlflow_flavor = None
+
+# Set this to export the model to ONNX when it is saved, which is the format the serving runtime loads.
+#  Only the first _onnx_sample_size rows of the training data are used to check and time the export.
+_export_onnx = False
+_quantize_onnx = False
+_onnx_sample_size = 100
+# The ONNX model must match the original on the sample within rtol of each prediction plus atol, or it isn't saved.
+#  float32 rounding grows with the predictions, so raise rtol rather than atol for models with large outputs.
+_onnx_rtol = float(getenv("ONNX_RTOL") or 1e-3)
+_onnx_atol = float(getenv("ONNX_ATOL") or 1e-4)
+
 
 def invalidate_models():
     if "single_model" in _model_cache:
@@ -19,12 +51,55 @@ def invalidate_models():
     if "models" in _model_cache:
         _model_cache.pop("models")
 
-def new_model():
-    model = None  # Put your default model constructor here.
+def new_model(**model_config):
+    model = None  # Put your default model constructor here. Any hyperparameters in model_config should be passed to it.
     return model
 
-def save_model(model):
-    save_to_mlflow(model, MODEL_VERSION, experiment_name=MODEL_NAME)
+def save_model(model,
+               submodel_name: Optional[str] = None,
+               immutable_metadata: Dict[str, str] = {},
+               sample_data: Optional[DataFrame] = None,
+               pipeline: Optional[Pipeline] = None,
+               mutable_metadata: Dict[str, float] = {},
+               parent_run_id: Optional[str] = None) -> str:
+    onnx_sample_data = None
+    if _export_onnx and sample_data is not None:
+        onnx_sample_data = sample_data.iloc[:_onnx_sample_size]
+    return save_to_mlflow(model, MODEL_VERSION, _mlflow_flavor, experiment_name=MODEL_NAME, submodel_name=submodel_name, immutable_metadata=immutable_metadata,
+                          mutable_metadata=mutable_metadata, onnx_sample_data=onnx_sample_data, quantize_onnx=_quantize_onnx, pipeline=pipeline,
+                          onnx_rtol=_onnx_rtol, onnx_atol=_onnx_atol, parent_run_id=parent_run_id)
+
+
+def start_search_run(immutable_metadata: Dict[str, str] = {}) -> str:
+    return start_parent_run(experiment_name=MODEL_NAME, immutable_metadata=immutable_metadata)
+
+
+def log_search_result(search_run_id: str, best_run_id: str, best_score: float):
+    log_to_run(search_run_id, {"best_run_id": best_run_id}, {"best_validation_score": best_score})
+
+
+def load_active_run(submodel_name: Optional[str] = None) -> Optional[Series]:
+    """
+    Finds the Active run that serves the most traffic, preferring the most recent one on a tie.
+
+    Args:
+        submodel_name (Optional[str]): Submodel name to restrict the search to, if you have one.
+    """
+    runs = list_runs(MODEL_VERSION, experiment_name=MODEL_NAME, active_state=ModelStatus.Active, submodel_name=submodel_name)
+    if runs.empty:
+        return None
+    # The runs are already ordered newest first, so a stable sort keeps the newest run first among equal fractions.
+    runs = runs.sort_values("metrics.test_fraction", ascending=False, kind="stable")
+    return runs.iloc[0]
+
+
+def load_run_model(run: Series):
+    return load_single_model(run, _mlflow_flavor)
+
+
+def load_run_pipeline(run: Series) -> Optional[Pipeline]:
+    return load_single_pipeline(run)
+
 
 def load_model():
     if "single_model" in _model_cache:
@@ -38,10 +113,23 @@ def load_model():
 
 
 def load_active_models() -> Dict[str, Union[Sequence, Tuple[Sequence, Sequence]]]:
+    if _frozen_models is not None:
+        return _frozen_models
     if "models" in _model_cache:
         return _model_cache["models"]
-    
-    models = list_models_with_metadata(MODEL_VERSION, experiment_name=MODEL_NAME, active_state=ModelStatus.Active)
+
+    return refresh_models()
+
+
+def refresh_models() -> Dict[str, Union[Sequence, Tuple[Sequence, Sequence]]]:
+    """
+    Loads the active models from MLflow, even if they are cached. The cached models are only replaced once the new ones are loaded.
+    Frozen models are never replaced here (see freeze_models).
+    """
+    if _frozen_models is not None:
+        return _frozen_models
+
+    models = _load_models_from_mlflow()
     # Don't cache if no models are found since this is technically unhealthy.
     if models:
         _model_cache["models"] = models
@@ -49,6 +137,66 @@ def load_active_models() -> Dict[str, Union[Sequence, Tuple[Sequence, Sequence]]
     return models
 
 
+def _load_models_from_mlflow() -> Dict[str, Union[Sequence, Tuple[Sequence, Sequence]]]:
+    try:
+        models = list_models_with_metadata(MODEL_VERSION, experiment_name=MODEL_NAME, active_state=ModelStatus.Active)
+    except Exception as e:
+        _model_load_state["error"] = repr(e)
+        raise
+
+    if models:
+        _model_load_state["loaded_at"] = time()
+        _model_load_state["error"] = None
+    else:
+        _model_load_state["error"] = "No active models were found."
+    return models
+
+
+def peek_active_models() -> Optional[Dict[str, Union[Sequence, Tuple[Sequence, Sequence]]]]:
+    """
+    Returns the active models if they are already loaded, without ever loading them.
+    """
+    if _frozen_models is not None:
+        return _frozen_models
+    return _model_cache.get("models")
+
+
+def get_model_load_state() -> Dict[str, Any]:
+    return dict(_model_load_state)
+
+
+def freeze_models():
+    """
+    Reloads the active models and keeps them until the next call, regardless of the cache expiry.
+    This is meant to be called in a process before it forks, so that its children share the models copy-on-write.
+    The models are only replaced once the new ones are loaded. If loading them fails, the error is raised and the previous
+    models stay frozen. If no models are found, the previous models are kept too, or if there are none, the models are loaded and cached as usual.
+    """
+    global _frozen_models
+    models = _load_models_from_mlflow()
+    if models:
+        _frozen_models = models
+        invalidate_models()
+
+
+def frozen_models_outdated() -> bool:
+    """
+    Checks whether the Active runs or their test fractions differ from the frozen models, without loading any model.
+    Finding no Active runs doesn't count as a change, since freeze_models would keep the frozen models anyway.
+    """
+    runs = list_runs(MODEL_VERSION, experiment_name=MODEL_NAME, active_state=ModelStatus.Active)
+    if runs.empty:
+        return False
+    if _frozen_models is None:
+        return True
+
+    # Compared after rebalancing, as the fractions of the loaded models are.
+    active_fractions = _rebalance_test_fractions(dict(zip(runs["run_id"], runs["metrics.test_fraction"])))
+    frozen_fractions = {run_id: get_model_metadata(model_data)["metrics.test_fraction"] for run_id, model_data in _frozen_models.items()}
+    return active_fractions.keys() != frozen_fractions.keys() or \
+        any(not isclose(fraction, frozen_fractions[run_id]) for run_id, fraction in active_fractions.items())
+
+
 def get_model_metadata(model_data: Union[Sequence, Tuple[Sequence, Sequence]]) -> Sequence:
     if USE_SERVING_RUNTIME:
         return model_data
@@ -59,3 +207,7 @@ def get_model(model_data: Union[Sequence, Tuple[Sequence, Sequence]]) -> Optiona
     if USE_SERVING_RUNTIME:
         return None
     return model_data[0]
+
+
+def get_pipeline(model_data: Union[Sequence, Tuple[Sequence, Sequence]]) -> Optional[Pipeline]:
+    return get_model_metadata(model_data).get("pipeline")
@@ -0,0 +1,153 @@
+from os import remove
+from os.path import getsize, join
+from pickle import dumps
+from statistics import median
+from time import perf_counter
+from typing import Any, Callable, Dict, Tuple
+
+import numpy as np
+from pandas import DataFrame
+
+# Must match the input that common.serving_runtime.predict sends to ModelMesh.
+ONNX_INPUT_NAME = "dense_input"
+ONNX_FILE_NAME = "model.onnx"
+QUANTIZED_ONNX_FILE_NAME = "model.int8.onnx"
+LATENCY_REPEATS = 50
+
+
+# skl2onnx and onnxruntime are only needed if you export to ONNX, so they are imported when used.
+def convert_to_onnx(model, sample_data: DataFrame):
+    from sklearn.base import is_classifier
+    from skl2onnx import convert_sklearn
+    from skl2onnx.common.data_types import FloatTensorType
+
+    initial_types = [(ONNX_INPUT_NAME, FloatTensorType([None, sample_data.shape[1]]))]
+    # Classifiers output a list of dictionaries by default, which the KServe v2 protocol can't return.
+    options = {id(model): {"zipmap": False}} if is_classifier(model) else None
+    return convert_sklearn(model, initial_types=initial_types, options=options)
+
+
+def optimize_onnx(input_path: str, output_path: str):
+    from onnxruntime import GraphOptimizationLevel, InferenceSession, SessionOptions
+
+    options = SessionOptions()
+    # Higher levels add onnxruntime-specific operators and hardware-specific layouts,
+    #  which the serving runtime isn't guaranteed to support.
+    options.graph_optimization_level = GraphOptimizationLevel.ORT_ENABLE_BASIC
+    options.optimized_model_filepath = output_path
+    InferenceSession(input_path, options, providers=["CPUExecutionProvider"])
+
+
+def quantize_onnx(input_path: str, output_path: str):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(input_path, output_path, weight_type=QuantType.QInt8)
+
+
+def _onnx_predictor(path: str) -> Callable[[np.ndarray], np.ndarray]:
+    from onnxruntime import InferenceSession
+
+    session = InferenceSession(path, providers=["CPUExecutionProvider"])
+    return lambda values: session.run(None, {ONNX_INPUT_NAME: values})[0]
+
+
+def _matches(expected: np.ndarray, actual: np.ndarray, rtol: float, atol: float) -> bool:
+    expected = np.asarray(expected).ravel()
+    actual = np.asarray(actual).ravel()
+    if expected.shape != actual.shape:
+        return False
+    if not np.issubdtype(expected.dtype, np.number):
+        return np.array_equal(expected, actual.astype(expected.dtype))
+    # The error allowed grows with the size of the outputs, since float32 rounding does too.
+    return bool(np.allclose(actual.astype(np.float64), expected.astype(np.float64), rtol=rtol, atol=atol))
+
+
+def _max_abs_error(expected: np.ndarray, actual: np.ndarray) -> float:
+    expected = np.asarray(expected).ravel()
+    actual = np.asarray(actual).ravel()
+    if expected.shape != actual.shape:
+        return float("inf")
+    if not np.issubdtype(expected.dtype, np.number):
+        # Class labels either match or they don't.
+        return 0.0 if np.array_equal(expected, actual.astype(expected.dtype)) else float("inf")
+    return float(np.max(np.abs(expected.astype(np.float64) - actual.astype(np.float64)), initial=0.0))
+
+
+def _median_latency_ms(predict: Callable[[Any], Any], data: Any) -> float:
+    predict(data)  # Warm up so that one-off allocations aren't measured.
+    timings = []
+    for _ in range(LATENCY_REPEATS):
+        start = perf_counter()
+        predict(data)
+        timings.append(perf_counter() - start)
+    return median(timings) * 1000
+
+
+def _prefer_quantized(metrics: Dict[str, float]) -> bool:
+    # Quantising small models can make them larger without making them any faster, in which case there's nothing to gain.
+    return metrics["onnx_int8_size_bytes"] < metrics["onnx_size_bytes"] or metrics["onnx_int8_latency_ms"] < metrics["onnx_latency_ms"]
+
+
+def export_onnx(model,
+                sample_data: DataFrame,
+                output_dir: str,
+                quantize: bool = False,
+                rtol: float = 1e-3,
+                atol: float = 1e-4,
+                quantized_rtol: float = 1e-2,
+                quantized_atol: float = 1e-2) -> Tuple[str, Dict[str, float]]:
+    """
+    Converts a model to an optimised ONNX graph, optionally with a dynamically quantised int8 copy, and checks both against the original model.
+
+    Args:
+        model: The fitted model to convert.
+        sample_data (DataFrame): A preprocessed sample batch to check parity and measure latency with.
+        output_dir (str): The directory to write the ONNX files into.
+        quantize (bool): Whether to also produce a dynamically quantised int8 model.
+        rtol (float): The difference allowed between the predictions of the model and the ONNX model, relative to the predictions.
+        atol (float): The absolute difference allowed on top of rtol, which matters for predictions close to 0.
+        quantized_rtol (float): rtol for the int8 model. If exceeded, the int8 model is kept but not served.
+        quantized_atol (float): atol for the int8 model.
+
+    Returns:
+        The name of the file in output_dir that should be served, and the size, latency and parity metrics of each model.
+    """
+    values = sample_data.values.astype(np.float32)
+    expected = model.predict(sample_data)
+
+    unoptimized_path = join(output_dir, "unoptimized.onnx")
+    with open(unoptimized_path, "wb") as onnx_file:
+        onnx_file.write(convert_to_onnx(model, sample_data).SerializeToString())
+    onnx_path = join(output_dir, ONNX_FILE_NAME)
+    optimize_onnx(unoptimized_path, onnx_path)
+    remove(unoptimized_path)
+
+    onnx_predict = _onnx_predictor(onnx_path)
+    metrics = {
+        "original_size_bytes": float(len(dumps(model))),
+        "original_latency_ms": _median_latency_ms(model.predict, sample_data),
+        "onnx_size_bytes": float(getsize(onnx_path)),
+        "onnx_latency_ms": _median_latency_ms(onnx_predict, values),
+    }
+    onnx_predictions = onnx_predict(values)
+    metrics["onnx_max_abs_error"] = _max_abs_error(expected, onnx_predictions)
+    if not _matches(expected, onnx_predictions, rtol, atol):
+        raise ValueError(f"The ONNX model does not match the original model: the largest error is {metrics['onnx_max_abs_error']}.")
+    serving_file = ONNX_FILE_NAME
+
+    if quantize:
+        quantized_path = join(output_dir, QUANTIZED_ONNX_FILE_NAME)
+        quantize_onnx(onnx_path, quantized_path)
+        quantized_predict = _onnx_predictor(quantized_path)
+        metrics["onnx_int8_size_bytes"] = float(getsize(quantized_path))
+        metrics["onnx_int8_latency_ms"] = _median_latency_ms(quantized_predict, values)
+        quantized_predictions = quantized_predict(values)
+        metrics["onnx_int8_max_abs_error"] = _max_abs_error(expected, quantized_predictions)
+        if not _matches(expected, quantized_predictions, quantized_rtol, quantized_atol):
+            print(f"The int8 model is not accurate enough to serve: the largest error is {metrics['onnx_int8_max_abs_error']}.")
+        elif not _prefer_quantized(metrics):
+            print("The int8 model is neither smaller nor faster than the float model, so the float model is served.")
+        else:
+            serving_file = QUANTIZED_ONNX_FILE_NAME
+
+    return serving_file, metrics
@@ -0,0 +1,313 @@
+from datetime import date
+from decimal import Decimal
+from math import isnan
+from statistics import median
+from threading import local
+from time import perf_counter_ns
+from typing import Any, Dict, List, Optional, Sequence, Type
+
+import numpy as np
+from pandas import DataFrame, Index, NaT, Series, Timestamp, unique
+from pandas.api.types import infer_dtype
+
+# A pipeline turns the preprocessed DataFrame into the float32 features the model is trained on and served with.
+#  It is declared in common.transformations.new_pipeline, fitted in training, and logged next to the model as JSON, so that
+#  training, evaluation and serving all transform the data with the same fitted state.
+#  Every step works on whole columns of one preallocated array, so there are no loops over the rows.
+PIPELINE_FILE_NAME = "pipeline.json"
+COST_REPEATS = 50
+COST_SAMPLE_ROWS = 10000
+# Above this many rows times categories, one-hot encoding looks the categories up in a hash table instead of comparing with each of them.
+ONE_HOT_BROADCAST_CELLS = 65536
+
+STEPS: Dict[str, Type["Step"]] = dict()
+
+
+def _category_key(value: Any) -> Any:
+    """
+    The value a category is stored and matched by. It must survive being saved as JSON, and values that mean the same
+    thing must map to the same key, e.g. a datetime64 in training and a date in a request.
+    """
+    if value is None or (isinstance(value, float) and isnan(value)) or value is NaT:
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, (str, bool, int, float)):
+        return value
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (date, np.datetime64)):
+        timestamp = Timestamp(value)
+        # Dates, and times at midnight, are keyed by the date alone.
+        if timestamp.tz is None and timestamp == timestamp.normalize():
+            return timestamp.strftime("%Y-%m-%d")
+        return str(timestamp)
+    return str(value)
+
+
+def _category_values(column: Series) -> np.ndarray:
+    # Fitting and transforming both go through this, so the values are compared by the same keys the categories are stored as.
+    if column.dtype.kind in "biufSU":
+        return column.to_numpy()
+    if column.dtype.kind == "M":
+        # Vectorised equivalent of _category_key for datetime64 columns.
+        keys = column.astype(str)
+        if column.dt.tz is None:
+            keys = keys.where(column != column.dt.normalize(), column.dt.strftime("%Y-%m-%d"))
+        return keys.to_numpy(dtype=object)
+    # Object columns only need converting element by element if they hold something other than strings and numbers.
+    if infer_dtype(column, skipna=True) in ("string", "integer", "floating", "mixed-integer-float", "boolean", "empty"):
+        return column.to_numpy()
+    return np.array([_category_key(value) for value in column], dtype=object)
+
+
+def register_step(name: str):
+    """
+    Class decorator to add a step, which can then be declared in a pipeline and loaded back from its JSON.
+    """
+    def register(step_class: Type["Step"]) -> Type["Step"]:
+        step_class.step_type = name
+        STEPS[name] = step_class
+        return step_class
+    return register
+
+
+class Step:
+    """
+    A transformation of the feature array. Steps modify the columns they name in place, unless they add columns of their own.
+    Anything a step learns in fit must be a constructor argument and returned by to_dict, so that it survives being saved.
+    """
+    step_type: str
+
+    def __init__(self, columns: Sequence[str]):
+        self.columns = list(columns)
+        self._indices = np.empty(0, dtype=np.intp)
+
+    def fit_columns(self, data: DataFrame):
+        # Only needed by steps that add columns, which must know them before the feature array is laid out.
+        pass
+
+    def added_columns(self) -> List[str]:
+        return []
+
+    def bind(self, column_index: Dict[str, int]):
+        self._indices = np.array([column_index[column] for column in self.columns], dtype=np.intp)
+
+    def fit(self, values: np.ndarray):
+        pass
+
+    def transform(self, data: DataFrame, values: np.ndarray):
+        raise NotImplementedError()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"type": self.step_type, "columns": self.columns}
+
+
+@register_step("standard_scale")
+class StandardScale(Step):
+    def __init__(self, columns: Sequence[str], mean: Optional[Sequence[float]] = None, scale: Optional[Sequence[float]] = None):
+        super().__init__(columns)
+        self.mean = None if mean is None else np.asarray(mean, dtype=np.float32)
+        self.scale = None if scale is None else np.asarray(scale, dtype=np.float32)
+
+    def fit(self, values: np.ndarray):
+        selected = values[:, self._indices]
+        self.mean = selected.mean(axis=0)
+        scale = selected.std(axis=0)
+        self.scale = np.where(scale > 0, scale, 1).astype(np.float32)  # Constant columns are only centred.
+
+    def transform(self, data: DataFrame, values: np.ndarray):
+        values[:, self._indices] = (values[:, self._indices] - self.mean) / self.scale
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {**super().to_dict(), "mean": self.mean.tolist(), "scale": self.scale.tolist()}
+
+
+@register_step("log1p")
+class Log1p(Step):
+    def transform(self, data: DataFrame, values: np.ndarray):
+        values[:, self._indices] = np.log1p(values[:, self._indices])
+
+
+@register_step("clip")
+class Clip(Step):
+    """
+    Clips each column to the given quantiles of the training data.
+    """
+    def __init__(self,
+                 columns: Sequence[str],
+                 lower_quantile: float = 0.,
+                 upper_quantile: float = 1.,
+                 lower: Optional[Sequence[float]] = None,
+                 upper: Optional[Sequence[float]] = None):
+        super().__init__(columns)
+        self.lower_quantile = lower_quantile
+        self.upper_quantile = upper_quantile
+        self.lower = None if lower is None else np.asarray(lower, dtype=np.float32)
+        self.upper = None if upper is None else np.asarray(upper, dtype=np.float32)
+
+    def fit(self, values: np.ndarray):
+        selected = values[:, self._indices]
+        self.lower = np.quantile(selected, self.lower_quantile, axis=0).astype(np.float32)
+        self.upper = np.quantile(selected, self.upper_quantile, axis=0).astype(np.float32)
+
+    def transform(self, data: DataFrame, values: np.ndarray):
+        values[:, self._indices] = np.clip(values[:, self._indices], self.lower, self.upper)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {**super().to_dict(),
+                "lower_quantile": self.lower_quantile,
+                "upper_quantile": self.upper_quantile,
+                "lower": self.lower.tolist(),
+                "upper": self.upper.tolist()}
+
+
+@register_step("one_hot")
+class OneHot(Step):
+    """
+    Encodes a column of the DataFrame as one column per category seen in training. Unseen categories are all zeros.
+    """
+    def __init__(self, column: str, categories: Optional[Sequence[Any]] = None):
+        super().__init__([])
+        self.column = column
+        self.categories = None if categories is None else list(categories)
+        self._start = 0
+
+    def fit_columns(self, data: DataFrame):
+        # Sorting by string works for columns of mixed types too.
+        values = unique(_category_values(data[self.column].dropna()))
+        self.categories = sorted({_category_key(value) for value in values.tolist()} - {None}, key=str)
+
+    def added_columns(self) -> List[str]:
+        return [f"{self.column}={category}" for category in self.categories]
+
+    def bind(self, column_index: Dict[str, int]):
+        self._start = column_index[self.added_columns()[0]] if self.categories else 0
+        self._category_array = np.array(self.categories, dtype=object)
+        self._category_index = Index(self.categories)
+
+    def transform(self, data: DataFrame, values: np.ndarray):
+        block = values[:, self._start:self._start + len(self.categories)]
+        column = _category_values(data[self.column])
+        if len(column) * len(self.categories) <= ONE_HOT_BROADCAST_CELLS:
+            # Comparing with every category at once is several times faster than hashing for the few rows of a request.
+            block[:] = column[:, np.newaxis] == self._category_array
+            return
+        codes = self._category_index.get_indexer(column)
+        block[:] = 0
+        rows = np.flatnonzero(codes >= 0)
+        block[rows, codes[rows]] = 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"type": self.step_type, "column": self.column, "categories": self.categories}
+
+
+class Pipeline:
+    """
+    Copies the numeric columns into a float32 array, then applies each step in order.
+
+    Args:
+        columns (Sequence[str]): The numeric columns of the DataFrame to use as features, in order.
+        steps (Sequence[Step]): The steps to apply. Columns added by steps come after the numeric columns.
+    """
+    def __init__(self, columns: Sequence[str], steps: Sequence[Step] = ()):
+        self.columns = list(columns)
+        self.steps = list(steps)
+        self.output_columns: List[str] = []
+        # Each thread reuses its own buffer across calls, e.g. the threads serving requests (see buffer).
+        self._buffers = local()
+
+    def _bind(self):
+        self.output_columns = self.columns + [column for step in self.steps for column in step.added_columns()]
+        # Building the Index once saves most of the cost of wrapping a single row in transform_frame.
+        self._output_index = Index(self.output_columns)
+        column_index = {column: i for i, column in enumerate(self.output_columns)}
+        for step in self.steps:
+            step.bind(column_index)
+
+    def _copy_columns(self, data: DataFrame, values: np.ndarray):
+        # One column at a time, so that no intermediate copy of the selected columns is made.
+        for i, column in enumerate(self.columns):
+            values[:, i] = data[column].to_numpy()
+
+    def fit(self, data: DataFrame) -> "Pipeline":
+        for step in self.steps:
+            step.fit_columns(data)
+        self._bind()
+
+        # Each step is fitted on the output of the ones before it, as it will see it when serving.
+        values = np.empty((len(data), len(self.output_columns)), dtype=np.float32)
+        self._copy_columns(data, values)
+        for step in self.steps:
+            step.fit(values)
+            step.transform(data, values)
+        return self
+
+    def buffer(self, rows: int) -> np.ndarray:
+        """
+        Returns a preallocated array for transform that belongs to the calling thread. It is overwritten by the next call in that thread.
+        """
+        values = getattr(self._buffers, "values", None)
+        if values is None or values.shape[0] < rows:
+            values = np.empty((rows, len(self.output_columns)), dtype=np.float32)
+            self._buffers.values = values
+        return values[:rows]
+
+    def transform(self, data: DataFrame, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Transforms the data into the float32 features of the model.
+
+        Args:
+            data (DataFrame): The preprocessed data.
+            out (Optional[np.ndarray]): An array of shape (rows, len(output_columns)) to write the features into, e.g. from buffer. Allocated if not provided.
+        """
+        if out is None:
+            out = np.empty((len(data), len(self.output_columns)), dtype=np.float32)
+        self._copy_columns(data, out)
+        for step in self.steps:
+            step.transform(data, out)
+        return out
+
+    def transform_frame(self, data: DataFrame, out: Optional[np.ndarray] = None) -> DataFrame:
+        # Wraps the array without copying it, so the model sees the same feature names it was trained with.
+        return DataFrame(self.transform(data, out), columns=self._output_index, index=data.index, copy=False)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"columns": self.columns, "steps": [step.to_dict() for step in self.steps]}
+
+    @classmethod
+    def from_dict(cls, pipeline_dict: Dict[str, Any]) -> "Pipeline":
+        steps = [STEPS[step_dict["type"]](**{key: value for key, value in step_dict.items() if key != "type"})
+                 for step_dict in pipeline_dict["steps"]]
+        pipeline = cls(pipeline_dict["columns"], steps)
+        pipeline._bind()
+        return pipeline
+
+
+def _median_ns(function, repeats: int) -> float:
+    function()  # Warm up so that one-off allocations aren't measured.
+    timings = []
+    for _ in range(repeats):
+        start = perf_counter_ns()
+        function()
+        timings.append(perf_counter_ns() - start)
+    return median(timings)
+
+
+def measure_pipeline(pipeline: Pipeline, data: DataFrame, repeats: int = COST_REPEATS) -> Dict[str, float]:
+    """
+    Measures how long the fitted pipeline takes per row on a batch of data, and for a single row as it is served.
+
+    Args:
+        pipeline (Pipeline): The fitted pipeline.
+        data (DataFrame): The preprocessed data to measure with, e.g. the training data. Only the first COST_SAMPLE_ROWS rows are used.
+        repeats (int): How many times to time each measurement.
+    """
+    data = data.iloc[:COST_SAMPLE_ROWS]
+    if data.empty:
+        return {}
+    single_row = data.iloc[:1]
+    return {
+        "pipeline_ns_per_row": _median_ns(lambda: pipeline.transform(data, pipeline.buffer(len(data))), repeats) / len(data),
+        "pipeline_single_row_ns": _median_ns(lambda: pipeline.transform(single_row, pipeline.buffer(1)), repeats)
+    }
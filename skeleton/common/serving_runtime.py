@@ -1,15 +1,17 @@
-from typing import Sequence
-from kubernetes import client, config, dynamic
-from kubernetes.client.rest import ApiException
+from typing import Optional, Sequence
 from os import getenv
 from pandas import DataFrame
 from re import sub
-from requests import post
 from traceback import print_exc
-from yaml import safe_load
 
 from common import MODEL_NAME, CACHE_TTL
 
+# kubernetes, yaml and requests are imported in the functions that use them.
+#  The serving app never manages models and only calls the serving runtime if USE_SERVING_RUNTIME is set,
+#  so this keeps them from slowing down its startup.
+
+MODELMESH_URL = getenv("MODELMESH_URL") or "http://modelmesh-serving:8008"
+
 
 _base_config_str = f"""apiVersion: serving.kserve.io/v1beta1
 kind: InferenceService
@@ -48,6 +50,8 @@ def _title_to_kebab_case(name: str) -> str:
 
 
 def _build_model_info(name: str, path: str) -> dict:
+    from yaml import safe_load
+
     base_config = safe_load(_base_config_str)
     base_config["metadata"]["annotations"]["openshift.io/display-name"] = name
     base_config["metadata"]["name"] = _title_to_kebab_case(name)
@@ -58,6 +62,9 @@ def _build_model_info(name: str, path: str) -> dict:
 
 
 def add_model(unique_id: str, path: str):
+    from kubernetes import client, config, dynamic
+    from kubernetes.client.rest import ApiException
+
     config.load_incluster_config()
     name = get_inference_service_name(unique_id)
     default_api_client = client.ApiClient()
@@ -99,6 +106,8 @@ def remove_model(unique_id: str):
     except Exception as e:
         print("Model not removed from the inference server. It may have already been removed.")
     """
+    from kubernetes import client, config
+
     config.load_incluster_config()
     delay_seconds = CACHE_TTL * 1.5
 
@@ -142,9 +151,12 @@ def remove_model(unique_id: str):
     batch.create_namespaced_job(body=job, namespace=_get_namespace())
 
 
-def predict(data: DataFrame, unique_id: str) -> Sequence:
+def predict(data: DataFrame, unique_id: str, timeout: Optional[float] = None) -> Sequence:
+    from requests import post
+    from requests.exceptions import Timeout
+
     model_name = get_inference_service_name(unique_id)
-    inference_url = f"http://modelmesh-serving:8008/v2/models/{model_name}/infer"
+    inference_url = f"{MODELMESH_URL}/v2/models/{model_name}/infer"
     json_data = {
         "inputs": [
             {
@@ -155,6 +167,9 @@ def predict(data: DataFrame, unique_id: str) -> Sequence:
             }
         ]
         }
-    response = post(inference_url, json=json_data)
+    try:
+        response = post(inference_url, json=json_data, timeout=timeout)
+    except Timeout as e:
+        raise TimeoutError(f"The serving runtime did not respond to {model_name} in time.") from e
     response_dict = response.json()
     return response_dict['outputs'][0]['data']
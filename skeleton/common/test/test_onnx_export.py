@@ -0,0 +1,64 @@
+from importlib.util import find_spec
+from os import listdir
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main, skipUnless
+from unittest.mock import patch
+
+import numpy as np
+from pandas import DataFrame
+from sklearn.linear_model import LinearRegression
+
+from common import onnx_export
+from common.onnx_export import ONNX_FILE_NAME, QUANTIZED_ONNX_FILE_NAME, export_onnx
+
+
+def build_data() -> DataFrame:
+    rng = np.random.default_rng(0)
+    return DataFrame(rng.normal(size=(50, 4)), columns=["a", "b", "c", "d"])
+
+
+@skipUnless(find_spec("skl2onnx") and find_spec("onnxruntime"), "skl2onnx and onnxruntime are needed to export to ONNX")
+class TestExportOnnx(TestCase):
+    def test_large_outputs_within_relative_tolerance(self):
+        data = build_data()
+        # Predictions around 2.5e5 are off by a few hundredths in float32, which only a relative tolerance allows.
+        model = LinearRegression().fit(data, 250000 + 1000 * data["a"])
+        with TemporaryDirectory() as output_dir:
+            serving_file, metrics = export_onnx(model, data, output_dir)
+            self.assertEqual(serving_file, ONNX_FILE_NAME)
+            self.assertIn(ONNX_FILE_NAME, listdir(output_dir))
+        self.assertGreater(metrics["onnx_size_bytes"], 0)
+
+    def test_mismatch_raises(self):
+        data = build_data()
+        model = LinearRegression().fit(data, data["a"])
+        with TemporaryDirectory() as output_dir, \
+                patch.object(onnx_export, "_onnx_predictor", return_value=lambda values: np.full(len(values), 1e3)):
+            with self.assertRaises(ValueError):
+                export_onnx(model, data, output_dir)
+
+    def test_quantized_served_only_if_smaller_or_faster(self):
+        data = build_data()
+        model = LinearRegression().fit(data, data["a"])
+        with TemporaryDirectory() as output_dir, patch.object(onnx_export, "_median_latency_ms", return_value=1.):
+            serving_file, metrics = export_onnx(model, data, output_dir, quantize=True, quantized_rtol=1., quantized_atol=1.)
+        # Quantising a model this small only adds to its size, and with equal latencies there is nothing to gain.
+        self.assertGreaterEqual(metrics["onnx_int8_size_bytes"], metrics["onnx_size_bytes"])
+        self.assertEqual(serving_file, ONNX_FILE_NAME)
+
+        faster = {"onnx_int8_latency_ms": 0.5, "onnx_latency_ms": 1.,
+                  "onnx_int8_size_bytes": metrics["onnx_int8_size_bytes"], "onnx_size_bytes": metrics["onnx_size_bytes"]}
+        self.assertTrue(onnx_export._prefer_quantized(faster))
+
+    def test_quantized_served_if_smaller(self):
+        data = build_data()
+        model = LinearRegression().fit(data, data["a"])
+        with TemporaryDirectory() as output_dir, \
+                patch.object(onnx_export, "_median_latency_ms", return_value=1.), \
+                patch.object(onnx_export, "getsize", side_effect=lambda path: 1. if path.endswith(QUANTIZED_ONNX_FILE_NAME) else 2.):
+            serving_file, _ = export_onnx(model, data, output_dir, quantize=True, quantized_rtol=1., quantized_atol=1.)
+        self.assertEqual(serving_file, QUANTIZED_ONNX_FILE_NAME)
+
+
+if __name__ == '__main__':
+    main()
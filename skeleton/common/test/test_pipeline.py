@@ -0,0 +1,78 @@
+from datetime import date, datetime
+from decimal import Decimal
+from json import dumps, loads
+from unittest import TestCase, main
+
+import numpy as np
+from pandas import DataFrame, date_range
+
+from common.pipeline import Clip, Log1p, OneHot, Pipeline, StandardScale
+
+
+def build_data() -> DataFrame:
+    return DataFrame({
+        "age": [20., 30., 40., 50.],
+        "income": [0., 10., 100., 1000.],
+        "country": ["ca", "us", "us", "mx"]
+    })
+
+
+def build_pipeline() -> Pipeline:
+    return Pipeline(["age", "income"], [Log1p(["income"]), Clip(["income"], 0., 0.75), StandardScale(["age", "income"]), OneHot("country")])
+
+
+class TestPipeline(TestCase):
+    def test_transform(self):
+        data = build_data()
+        pipeline = build_pipeline().fit(data)
+        values = pipeline.transform(data)
+
+        self.assertEqual(pipeline.output_columns, ["age", "income", "country=ca", "country=mx", "country=us"])
+        self.assertEqual(values.dtype, np.float32)
+        np.testing.assert_allclose(values[:, :2].mean(axis=0), 0, atol=1e-6)
+        np.testing.assert_array_equal(values[:, 2:], [[1, 0, 0], [0, 0, 1], [0, 0, 1], [0, 1, 0]])
+
+    def test_unseen_category(self):
+        pipeline = build_pipeline().fit(build_data())
+        values = pipeline.transform(DataFrame({"age": [25.], "income": [5.], "country": ["fr"]}))
+        np.testing.assert_array_equal(values[:, 2:], [[0, 0, 0]])
+
+    def test_round_trip(self):
+        data = build_data()
+        pipeline = build_pipeline().fit(data)
+        loaded = Pipeline.from_dict(loads(dumps(pipeline.to_dict())))
+
+        self.assertEqual(loaded.output_columns, pipeline.output_columns)
+        np.testing.assert_array_equal(loaded.transform(data, loaded.buffer(len(data))), pipeline.transform(data))
+
+
+    def test_mixed_and_date_categories(self):
+        data = DataFrame({"code": ["a", 1, "b", 2.5, None], "day": date_range("2024-01-01", periods=5)})
+        pipeline = Pipeline([], [OneHot("code"), OneHot("day")]).fit(data)
+        loaded = Pipeline.from_dict(loads(dumps(pipeline.to_dict())))
+
+        self.assertEqual(loaded.steps[0].categories, [1, 2.5, "a", "b"])
+        np.testing.assert_array_equal(loaded.transform(data), pipeline.transform(data))
+        np.testing.assert_array_equal(pipeline.transform(data)[:, 4:].sum(axis=1), 1)
+
+
+    def test_object_date_and_decimal_categories(self):
+        data = DataFrame({"day": [date(2024, 1, 1), date(2024, 1, 2), date(2024, 1, 1)],
+                          "price": [Decimal("1.5"), Decimal("2"), Decimal("1.5")]})
+        pipeline = Pipeline([], [OneHot("day"), OneHot("price")]).fit(data)
+        loaded = Pipeline.from_dict(loads(dumps(pipeline.to_dict())))
+
+        expected = [[1, 0, 1, 0], [0, 1, 0, 1], [1, 0, 1, 0]]
+        np.testing.assert_array_equal(pipeline.transform(data), expected)
+        np.testing.assert_array_equal(loaded.transform(data), expected)
+
+    def test_datetime64_training_matches_serving_dates(self):
+        training = DataFrame({"day": date_range("2024-01-01", periods=3), "at": date_range("2024-01-01 10:00", periods=3)})
+        pipeline = Pipeline.from_dict(loads(dumps(Pipeline([], [OneHot("day"), OneHot("at")]).fit(training).to_dict())))
+
+        request = DataFrame([{"day": date(2024, 1, 2), "at": datetime(2024, 1, 3, 10)}])
+        np.testing.assert_array_equal(pipeline.transform(request), [[0, 1, 0, 0, 0, 1]])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+from contextlib import nullcontext
+from os import getenv
+
+# Tracing is off unless TRACE_SAMPLE_RATE is above 0 and configure_tracing has been called in the process.
+#  Sampled spans go to the OTLP collector at OTEL_EXPORTER_OTLP_ENDPOINT if it is set, or are appended to TRACE_FILE as JSON lines.
+TRACE_SAMPLE_RATE = float(getenv("TRACE_SAMPLE_RATE") or 0)
+# The default is somewhere the container's non-root user can write to, unlike the directory the app is copied into.
+TRACE_FILE = getenv("TRACE_FILE") or "/tmp/traces.jsonl"
+
+_tracer = None
+
+
+class _LazyTraceFile:
+    """
+    Opens TRACE_FILE when the first spans are exported rather than at startup, so a path that can't be written to
+    drops the spans instead of stopping the app from booting.
+    """
+    def __init__(self, path: str):
+        self._path = path
+        self._file = None
+        self._failed = False
+
+    def write(self, text: str):
+        if self._file is None and not self._failed:
+            try:
+                self._file = open(self._path, "a")
+            except OSError as e:
+                self._failed = True
+                print(f"Could not open {self._path} to write traces to, so they are dropped: {e}")
+        if self._file is not None:
+            self._file.write(text)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+
+def tracing_enabled() -> bool:
+    return TRACE_SAMPLE_RATE > 0
+
+
+def configure_tracing(service_name: str):
+    """
+    Sets up the tracer for this process. It starts an exporting thread, so call it after forking.
+
+    Args:
+        service_name (str): The name the spans are reported under.
+    """
+    global _tracer
+    if not tracing_enabled():
+        return
+
+    # opentelemetry is only needed if tracing is enabled, so it is imported here.
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+
+    if getenv("OTEL_EXPORTER_OTLP_ENDPOINT"):
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        exporter = OTLPSpanExporter()
+    else:
+        exporter = ConsoleSpanExporter(out=_LazyTraceFile(TRACE_FILE), formatter=lambda span: span.to_json(indent=None) + "\n")
+
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}),
+                              sampler=ParentBased(TraceIdRatioBased(TRACE_SAMPLE_RATE)))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    _tracer = provider.get_tracer(__name__)
+
+
+def span(name: str, **attributes):
+    """
+    Context manager that records a span as a child of the current one. It does nothing if tracing isn't configured.
+
+    Args:
+        name (str): The name of the span.
+        attributes: Attributes to attach to the span, e.g. the run_id of the model.
+    """
+    if _tracer is None:
+        return nullcontext()
+    return _tracer.start_as_current_span(name, attributes={key: value for key, value in attributes.items() if value is not None})
+
+
+def set_span_attributes(**attributes):
+    """
+    Attaches attributes to the current span, e.g. once the run_id of the model is known.
+    """
+    if _tracer is None:
+        return
+    from opentelemetry.trace import get_current_span
+    get_current_span().set_attributes(attributes)
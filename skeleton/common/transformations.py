@@ -1,7 +1,9 @@
 from pandas import DataFrame
 from typing import Optional, Any
 
+from common.pipeline import Pipeline
 from common.serving_runtime import predict
+from common.tracing import span
 
 
 # Be very careful - the data contracts for these functions are overly flexible.
@@ -14,6 +16,13 @@ def preprocess(data: DataFrame) -> DataFrame:
 
     return transformed_data
 
+def new_pipeline() -> Optional[Pipeline]:
+    # Declare the features here if they need state fitted on the training data, e.g.
+    #  Pipeline(["age", "income"], [Log1p(["income"]), StandardScale(["age", "income"]), OneHot("country")])
+    #  It is fitted on the output of preprocess in training, saved with the model, and applied after preprocess wherever the model is used.
+    pipeline = None
+    return pipeline
+
 def postprocess(data: DataFrame) -> DataFrame:
     transformed_data = data
     # Any postprocessing that needs to happen when both training and serving goes here
@@ -21,11 +30,22 @@ def postprocess(data: DataFrame) -> DataFrame:
     return transformed_data
 
 
-def infer(data: DataFrame, model: Optional[Any], unique_id: Optional[str] = None):
-    preprocessed_data = preprocess(data)
+def infer(data: DataFrame,
+          model: Optional[Any],
+          unique_id: Optional[str] = None,
+          timeout: Optional[float] = None,
+          pipeline: Optional[Pipeline] = None):
+    with span("preprocess", run_id=unique_id):
+        preprocessed_data = preprocess(data)
+        if pipeline is not None:
+            # The features are written into a buffer owned by this thread, which is only reused once this call returns.
+            preprocessed_data = pipeline.transform_frame(preprocessed_data, pipeline.buffer(len(preprocessed_data)))
     if model:
-        predictions = model.predict(preprocessed_data)
+        with span("model.predict", run_id=unique_id):
+            predictions = model.predict(preprocessed_data)
     else:
-        predictions = predict(data, unique_id)
-    results = postprocess(predictions)
+        with span("serving_runtime.predict", run_id=unique_id):
+            predictions = predict(preprocessed_data, unique_id, timeout)
+    with span("postprocess", run_id=unique_id):
+        results = postprocess(predictions)
     return results
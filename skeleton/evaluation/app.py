@@ -1,11 +1,13 @@
 from common import MODEL_NAME, MODEL_VERSION
-from common.mlflow_api import list_runs, load_single_model, update_active_runs
+from common.mlflow_api import list_runs, load_single_model, load_single_pipeline, update_active_runs
 from common.model_status import ModelStatus
+from common.pipeline import Pipeline
 from common.transformations import infer
 from evaluation.load_data import load_evaluation_data
 
 from pandas import concat, DataFrame
 from sklearn.metrics import accuracy_score
+from typing import Optional
 
 
 def load_live_runs() -> DataFrame:
@@ -16,8 +18,8 @@ def load_live_runs() -> DataFrame:
     return runs
 
 
-def evaluate_model_on_data(data: DataFrame, model) -> float:
-    predictions = infer(data, model)
+def evaluate_model_on_data(data: DataFrame, model, pipeline: Optional[Pipeline] = None) -> float:
+    predictions = infer(data, model, pipeline=pipeline)
     target_column = 'target'
     actuals = data[target_column]
     return accuracy_score(actuals, predictions)
@@ -33,7 +35,7 @@ def main():
         model = load_single_model(run)
         if run['metrics.active_state'] == ModelStatus.Active.value:
             new_valid_runs[run.run_id] = 2.
-        elif evaluate_model_on_data(data, model) > 0.95:
+        elif evaluate_model_on_data(data, model, load_single_pipeline(run)) > 0.95:
             new_valid_runs[run.run_id] = 1.
         else:
             new_valid_runs[run.run_id] = 0.
@@ -0,0 +1,119 @@
+from asyncio import Semaphore, TimeoutError, wait_for
+from contextlib import asynccontextmanager
+from fastapi import HTTPException, Request, status
+from math import isfinite
+from os import getenv
+from time import monotonic
+from typing import AsyncIterator
+
+from common.tracing import span
+
+# Limits are per worker. Requests beyond MAX_IN_FLIGHT_REQUESTS wait in a queue of up to MAX_QUEUED_REQUESTS,
+#  and anything beyond that is turned away immediately instead of piling up behind slow predictions.
+MAX_IN_FLIGHT_REQUESTS = int(getenv("MAX_IN_FLIGHT_REQUESTS") or 8)
+MAX_QUEUED_REQUESTS = int(getenv("MAX_QUEUED_REQUESTS") or 32)
+# Clients can send how long they are willing to wait in this header, in milliseconds. Otherwise, the default applies.
+DEADLINE_HEADER = "X-Request-Timeout-Ms"
+DEFAULT_REQUEST_TIMEOUT_MS = float(getenv("DEFAULT_REQUEST_TIMEOUT_MS") or 10000)
+# Clients can ask for a shorter timeout than this, but not a longer one.
+MAX_REQUEST_TIMEOUT_MS = float(getenv("MAX_REQUEST_TIMEOUT_MS") or 60000)
+RETRY_AFTER_SECONDS = "1"
+# How much each finished request moves the estimate of how long requests take to process, which predicts the wait in the queue.
+SERVICE_TIME_SMOOTHING = 0.2
+
+
+def _deadline_exceeded() -> HTTPException:
+    return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                         detail="The request could not be completed before its deadline.",
+                         headers={"Retry-After": RETRY_AFTER_SECONDS})
+
+
+def remaining_seconds(deadline: float) -> float:
+    """
+    Returns the time left before a deadline, or rejects the request if there is none left.
+
+    Args:
+        deadline (float): The deadline, as a time.monotonic() value.
+    """
+    remaining = deadline - monotonic()
+    if remaining <= 0:
+        raise _deadline_exceeded()
+    return remaining
+
+
+class AdmissionController:
+    """
+    Bounds how many requests are processed at once and how many may wait for their turn.
+    This runs on the event loop, so requests are turned away before they take up a thread from the pool.
+    Requests that would wait in the queue past their deadline, going by how long recent requests took, are turned away
+    straight away rather than when their deadline passes.
+    """
+    def __init__(self, max_in_flight: int, max_queued: int):
+        self._semaphore = Semaphore(max_in_flight)
+        self._max_in_flight = max_in_flight
+        self._max_queued = max_queued
+        self._queued = 0
+        # A moving average of how long admitted requests took, or 0 until one has finished.
+        self._service_seconds = 0.
+
+    def _expected_wait(self) -> float:
+        # Every request ahead in the queue, and then this one, waits for one of max_in_flight requests to finish.
+        return (self._queued + 1) * self._service_seconds / self._max_in_flight
+
+    def _observe(self, seconds: float):
+        if self._service_seconds == 0:
+            self._service_seconds = seconds
+        else:
+            self._service_seconds += SERVICE_TIME_SMOOTHING * (seconds - self._service_seconds)
+
+    @asynccontextmanager
+    async def admit(self, deadline: float) -> AsyncIterator[None]:
+        if self._semaphore.locked() and self._queued >= self._max_queued:
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                                detail="Too many requests are already waiting.",
+                                headers={"Retry-After": RETRY_AFTER_SECONDS})
+        if self._semaphore.locked() and self._expected_wait() > remaining_seconds(deadline):
+            raise _deadline_exceeded()
+
+        self._queued += 1
+        try:
+            with span("admission"):
+                await wait_for(self._semaphore.acquire(), remaining_seconds(deadline))
+        except TimeoutError:
+            raise _deadline_exceeded()
+        finally:
+            self._queued -= 1
+
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self._observe(monotonic() - start)
+            self._semaphore.release()
+
+
+_admission_controller = AdmissionController(MAX_IN_FLIGHT_REQUESTS, MAX_QUEUED_REQUESTS)
+
+
+def _request_deadline(request: Request) -> float:
+    timeout_ms = request.headers.get(DEADLINE_HEADER)
+    if timeout_ms is None:
+        return monotonic() + DEFAULT_REQUEST_TIMEOUT_MS / 1000
+    try:
+        timeout_ms = float(timeout_ms)
+    except ValueError:
+        timeout_ms = None
+    # nan and inf parse as floats, but would break the wait for admission or turn off the deadline altogether.
+    if timeout_ms is None or not isfinite(timeout_ms) or timeout_ms <= 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"{DEADLINE_HEADER} must be a positive number of milliseconds.")
+    return monotonic() + min(timeout_ms, MAX_REQUEST_TIMEOUT_MS) / 1000
+
+
+async def admit_request(request: Request) -> AsyncIterator[float]:
+    """
+    FastAPI dependency that admits a request, or rejects it with a 429 if the queue is full or a 503 if it can't be served before its deadline.
+    Yields the deadline of the request, as a time.monotonic() value.
+    """
+    deadline = _request_deadline(request)
+    async with _admission_controller.admit(deadline):
+        yield deadline
@@ -1,27 +1,79 @@
-from typing import Tuple, Dict, Sequence, Union
+from typing import Any, Tuple, Dict, Sequence, Union
+from asyncio import Event, Lock, create_task, to_thread, wait_for
+from asyncio import TimeoutError as WaitTimeoutError
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Response, status
+from os import getenv, getppid, kill
+from fastapi import Depends, FastAPI, HTTPException, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pandas import DataFrame
 from random import seed, random
+from signal import SIGHUP
 from socket import gethostbyname, gethostname
-from time import time_ns
+from time import time, time_ns
+from traceback import print_exc
 from uvicorn import run
 
+from admission import RETRY_AFTER_SECONDS, admit_request, remaining_seconds
 from contract import Contract, ResponseContract, ModelMetadata
-from common import USE_SERVING_RUNTIME
-from common.model_factory import invalidate_models, load_active_models, get_model_metadata, get_model
+from ensemble import ENSEMBLE_MODE, ENSEMBLE_AGGREGATOR, aggregate, group_by_submodel, predict_members, validate_aggregator
+from profiler import sample_stacks, to_collapsed
+from common import USE_SERVING_RUNTIME, CACHE_TTL, MODEL_NAME, MODEL_VERSION, _strtobool
+from common.model_factory import (
+    refresh_models,
+    peek_active_models,
+    get_model_load_state,
+    get_model_metadata,
+    get_model,
+    get_pipeline
+)
+from common.tracing import configure_tracing, set_span_attributes, span, tracing_enabled
 from common.transformations import infer
 
+# Set by gunicorn.conf.py, where the models are loaded once in the gunicorn master and shared by the workers it forks.
+SERVING_PREFORK = _strtobool(getenv("SERVING_PREFORK") or "False")
+
+# The models are reloaded in the background well before the cache expires, and retried sooner if loading them fails.
+MODEL_REFRESH_SECONDS = CACHE_TTL / 2
+MODEL_RETRY_SECONDS = 10
+
+# The /admin endpoints, e.g. the profiler, are only registered if this is set. They are not authenticated, so only enable
+#  them where they can't be reached from outside the cluster, e.g. by excluding /admin from the Route.
+ENABLE_ADMIN_ENDPOINTS = _strtobool(getenv("ENABLE_ADMIN_ENDPOINTS") or "False")
+PROFILE_MAX_SECONDS = 60
+
+
 def seed_by_time():
     # Seed the RNG at the start of the process by a combination of host IP and time to be unique across multiple instances.
     seed(time_ns() + hash(gethostbyname(gethostname())))
 
+
+async def refresh_models_periodically(reload_requested: Event):
+    while True:
+        # Reloads requested while this one runs are all served by the next one.
+        reload_requested.clear()
+        try:
+            models = await to_thread(refresh_models)
+        except Exception:
+            print_exc()
+            models = None
+        try:
+            await wait_for(reload_requested.wait(), MODEL_REFRESH_SECONDS if models else MODEL_RETRY_SECONDS)
+        except WaitTimeoutError:
+            pass
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     seed_by_time()
-    load_active_models()
+    if ENSEMBLE_MODE:
+        validate_aggregator()
+    configure_tracing(f"{MODEL_NAME}-serving")
+    # The models are loaded by this task rather than before startup, so the probes can report on a slow or failed load.
+    app.state.reload_requested = Event()
+    app.state.model_refresh = create_task(refresh_models_periodically(app.state.reload_requested))
     yield
+    app.state.model_refresh.cancel()
 
 app = FastAPI(lifespan=lifespan)
 app.add_middleware(CORSMiddleware,
@@ -31,26 +83,67 @@ app.add_middleware(CORSMiddleware,
                    allow_headers=["*"]
                    )
 
+if tracing_enabled():
+    # The time in this span that isn't in its children is spent parsing and validating the request.
+    @app.middleware("http")
+    async def trace_requests(request: Request, call_next):
+        with span(f"{request.method} {request.url.path}"):
+            return await call_next(request)
+
+
+@app.exception_handler(TimeoutError)
+async def timeout_handler(request: Request, exc: TimeoutError) -> JSONResponse:
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        content={"detail": str(exc)},
+                        headers={"Retry-After": RETRY_AFTER_SECONDS})
+
+
+# The health checks only read what is already in memory. They never load the models themselves,
+#  since a probe that waits on MLflow can time out and get a pod restarted just for being slow.
 @app.get("/health")
-def healthcheck(response: Response) -> str:
-    if not load_active_models():
+async def healthcheck(response: Response) -> str:
+    if not peek_active_models():
         response.status_code = status.HTTP_404_NOT_FOUND
         return "Unhealthy"
-        
+
     return "Ok"
 
 
+@app.get("/livez")
+async def liveness(response: Response) -> str:
+    if app.state.model_refresh.done():
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return "Unhealthy"
+
+    return "Ok"
+
+
+@app.get("/readyz")
+async def readiness(response: Response) -> Dict[str, Any]:
+    load_state = get_model_load_state()
+    ready = bool(peek_active_models())
+    if not ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+
+    return {
+        "ready": ready,
+        "models_age_seconds": None if load_state["loaded_at"] is None else time() - load_state["loaded_at"],
+        "last_error": load_state["error"]
+    }
+
+
 def choose_request_model(models: Dict[str, Union[Sequence, Tuple[Sequence, Sequence]]]) -> str:
     """
     Randomly select a live model to predict with based on the test fractions provided.
 
     Args:
-        models: The models and metadata as loaded from MLflow
+        models: The models and metadata as loaded from MLflow, or a subset of them
 
     Returns:
         The selected run id.
     """
-    rng_value = random()
+    # Scaling by the total lets this choose within a subset of the models, whose fractions don't add up to 1.
+    rng_value = random() * sum(get_model_metadata(x)['metrics.test_fraction'] for x in models.values())
     total_value = 0
     for run_id, this_model_data in models.items():
         metadata = get_model_metadata(this_model_data)
@@ -59,31 +152,90 @@ def choose_request_model(models: Dict[str, Union[Sequence, Tuple[Sequence, Seque
             return run_id
 
 
+def build_model_metadata(model_id: str, metadata: Sequence) -> ModelMetadata:
+    return ModelMetadata(model_id=model_id,
+                         model_version=f"{metadata['params.major_version']}.{metadata['params.minor_version']}.{metadata['params.micro_version']}",
+                         submodel_name=metadata['params.submodel_name'])
+
+
+# The models are reloaded in the background, so this returns before they are. /readyz reports when they were last loaded.
 @app.put("/reload_models")
-def reload_models() -> bool:
-    invalidate_models()
+async def reload_models() -> bool:
+    if SERVING_PREFORK:
+        # The master reloads the models once and replaces every worker, rather than each worker loading its own copy.
+        kill(getppid(), SIGHUP)
+    else:
+        # Wakes up the background refresh, so that any number of calls share a single load of the models.
+        app.state.reload_requested.set()
     return True
 
 
 @app.post("/predict")
-def predict(request: Contract) -> ResponseContract:
-    data = DataFrame([request.model_dump()])
-
-    models = load_active_models()
-    model_id = choose_request_model(models)
+def predict(request: Contract, deadline: float = Depends(admit_request)) -> ResponseContract:
+    with span("build_dataframe"):
+        data = DataFrame([request.model_dump()])
+
+    # Only the background refresh loads the models, so that requests can't pile onto MLflow while they are missing.
+    models = peek_active_models()
+    if not models:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="The models are not loaded yet.",
+                            headers={"Retry-After": RETRY_AFTER_SECONDS})
+    if ENSEMBLE_MODE:
+        return predict_with_ensemble(data, models, deadline)
+
+    with span("choose_request_model"):
+        model_id = choose_request_model(models)
+    set_span_attributes(run_id=model_id)
     this_model = models[model_id]
     metadata = get_model_metadata(this_model)
-    this_model_version = f"{metadata['params.major_version']}.{metadata['params.minor_version']}.{metadata['params.micro_version']}"
 
     model = get_model(this_model)
-    results = infer(data, model, metadata.run_id)
+    # The time left is passed on as the timeout of the call to the serving runtime, so no work is done after the client gives up.
+    results = infer(data, model, metadata.run_id, remaining_seconds(deadline), get_pipeline(this_model))
 
-    metadata = ModelMetadata(model_id=model_id,
-                             model_version=this_model_version,
-                             submodel_name=metadata['params.submodel_name'])
     return ResponseContract(value=results[0],
+                            metadata=[build_model_metadata(model_id, metadata)])
+
+
+def predict_with_ensemble(data: DataFrame,
+                          models: Dict[str, Union[Sequence, Tuple[Sequence, Sequence]]],
+                          deadline: float) -> ResponseContract:
+    # Each submodel still chooses between its own runs by their test fractions.
+    run_ids = {submodel_name: choose_request_model(submodels) for submodel_name, submodels in group_by_submodel(models).items()}
+    results = predict_members(data, {submodel_name: models[run_id] for submodel_name, run_id in run_ids.items()}, deadline)
+    predictions = results.predictions
+    if not predictions:
+        # Only a slow ensemble is worth retrying. If every member failed, the error is reported as it is.
+        if results.timed_out or results.rejected:
+            raise TimeoutError("No submodel of the ensemble answered in time.")
+        raise RuntimeError(f"Every submodel of the ensemble failed: {', '.join(results.failed)}.") from next(iter(results.failed.values()))
+
+    contributors = [build_model_metadata(run_ids[submodel_name], get_model_metadata(models[run_ids[submodel_name]]))
+                    for submodel_name in predictions]
+    metadata = ModelMetadata(model_id="ensemble",
+                             model_version=MODEL_VERSION,
+                             submodel_name=ENSEMBLE_AGGREGATOR,
+                             extra_metadata=contributors)
+    return ResponseContract(value=aggregate(predictions),
                             metadata=[metadata])
 
 
+if ENABLE_ADMIN_ENDPOINTS:
+    _profile_lock = Lock()
+
+    @app.get("/admin/profile", response_class=PlainTextResponse)
+    async def profile(seconds: float = 10, interval_ms: float = 5) -> str:
+        """
+        Profiles this worker for a while and returns the sampled stacks in the collapsed format, ready for a flame graph.
+        """
+        if _profile_lock.locked():
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="A profile is already running.")
+
+        async with _profile_lock:
+            counts = await to_thread(sample_stacks, min(seconds, PROFILE_MAX_SECONDS), max(interval_ms, 1) / 1000)
+        return to_collapsed(counts)
+
+
 if __name__ == '__main__':
     run(app, host="0.0.0.0", port=8000)
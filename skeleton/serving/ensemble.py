@@ -0,0 +1,136 @@
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextvars import copy_context
+from os import getenv
+from statistics import mean, median
+from threading import BoundedSemaphore
+from time import monotonic
+from traceback import print_exception
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from pandas import DataFrame
+
+from common import _strtobool
+from common.model_factory import get_model_metadata, get_model, get_pipeline
+from common.transformations import infer
+
+# In ensemble mode, each request is sent to one active run of every submodel at the same time, and their predictions are combined.
+#  A submodel that doesn't answer within ENSEMBLE_MEMBER_TIMEOUT_MS (or before the request's deadline) is left out.
+ENSEMBLE_MODE = _strtobool(getenv("ENSEMBLE_MODE") or "False")
+ENSEMBLE_MEMBER_TIMEOUT_MS = float(getenv("ENSEMBLE_MEMBER_TIMEOUT_MS") or 1000)
+ENSEMBLE_AGGREGATOR = getenv("ENSEMBLE_AGGREGATOR") or "mean"
+ENSEMBLE_THREADS = int(getenv("ENSEMBLE_THREADS") or 32)
+# Models loaded in this process can't be stopped once they start predicting, so they get threads of their own, and a member is
+#  left out of a request when all of them are busy. Otherwise, slow local members could take every thread from the remote ones.
+ENSEMBLE_LOCAL_THREADS = int(getenv("ENSEMBLE_LOCAL_THREADS") or 8)
+
+# Aggregators take the prediction of each submodel that answered in time, by submodel name, and return the combined prediction.
+AGGREGATORS: Dict[str, Callable[[Dict[str, Any]], float]] = {
+    "mean": lambda predictions: mean(predictions.values()),
+    "median": lambda predictions: median(predictions.values()),
+    "max": lambda predictions: max(predictions.values()),
+    "min": lambda predictions: min(predictions.values())
+}
+
+# Threads are only started when they are first needed, so this is safe to create before the serving workers are forked.
+_executor = ThreadPoolExecutor(max_workers=ENSEMBLE_THREADS, thread_name_prefix="ensemble")
+_local_executor = ThreadPoolExecutor(max_workers=ENSEMBLE_LOCAL_THREADS, thread_name_prefix="ensemble-local")
+# Held from when a local member is submitted until it finishes, so it never waits in the queue of _local_executor.
+_local_slots = BoundedSemaphore(ENSEMBLE_LOCAL_THREADS)
+
+
+def register_aggregator(name: str):
+    """
+    Decorator to add an aggregator, which can then be selected with ENSEMBLE_AGGREGATOR.
+    """
+    def register(aggregator: Callable[[Dict[str, Any]], float]) -> Callable[[Dict[str, Any]], float]:
+        AGGREGATORS[name] = aggregator
+        return aggregator
+    return register
+
+
+def validate_aggregator():
+    """
+    Checks that ENSEMBLE_AGGREGATOR names a known aggregator. Call it at startup, once any custom aggregators are registered.
+    """
+    if ENSEMBLE_AGGREGATOR not in AGGREGATORS:
+        raise ValueError(f"Unknown ENSEMBLE_AGGREGATOR {ENSEMBLE_AGGREGATOR}. It must be one of {', '.join(AGGREGATORS)}.")
+
+
+def aggregate(predictions: Dict[str, Any]) -> float:
+    return float(AGGREGATORS[ENSEMBLE_AGGREGATOR](predictions))
+
+
+def group_by_submodel(models: Dict[str, Union[Sequence, Tuple[Sequence, Sequence]]]) -> Dict[str, Dict[str, Union[Sequence, Tuple[Sequence, Sequence]]]]:
+    groups = dict()
+    for run_id, model_data in models.items():
+        submodel_name = get_model_metadata(model_data)['params.submodel_name']
+        groups.setdefault(submodel_name, dict())[run_id] = model_data
+    return groups
+
+
+def _predict_member(data: DataFrame, model_data: Union[Sequence, Tuple[Sequence, Sequence]], deadline: float) -> Any:
+    timeout = max(deadline - monotonic(), 0.001)
+    return infer(data, get_model(model_data), get_model_metadata(model_data).run_id, timeout, get_pipeline(model_data))[0]
+
+
+class MemberResults(NamedTuple):
+    # The predictions of the members that answered in time, by submodel name.
+    predictions: Dict[str, Any]
+    # The members that were still predicting at the deadline.
+    timed_out: List[str]
+    # The members that raised an error, with that error.
+    failed: Dict[str, BaseException]
+    # The local members that were not run, because every local thread was busy.
+    rejected: List[str]
+
+
+def _submit_member(data: DataFrame, model_data: Union[Sequence, Tuple[Sequence, Sequence]], deadline: float) -> Optional[Future]:
+    # Each member runs in a copy of the current context, so that its spans are traced as part of this request.
+    if get_model(model_data) is None:
+        return _executor.submit(copy_context().run, _predict_member, data, model_data, deadline)
+
+    if not _local_slots.acquire(blocking=False):
+        return None
+    future = _local_executor.submit(copy_context().run, _predict_member, data, model_data, deadline)
+    future.add_done_callback(lambda _: _local_slots.release())
+    return future
+
+
+def predict_members(data: DataFrame,
+                    members: Dict[str, Union[Sequence, Tuple[Sequence, Sequence]]],
+                    deadline: float) -> MemberResults:
+    """
+    Predicts with every member of the ensemble concurrently. Only the members that answer in time contribute a prediction.
+
+    Args:
+        data (DataFrame): The request data.
+        members (Dict[str, Union[Sequence, Tuple[Sequence, Sequence]]]): The model data to predict with, by submodel name.
+        deadline (float): The deadline of the request, as a time.monotonic() value.
+    """
+    member_deadline = min(deadline, monotonic() + ENSEMBLE_MEMBER_TIMEOUT_MS / 1000)
+    futures = dict()
+    rejected = []
+    for submodel_name, model_data in members.items():
+        future = _submit_member(data, model_data, member_deadline)
+        if future is None:
+            rejected.append(submodel_name)
+        else:
+            futures[future] = submodel_name
+    done, not_done = wait(futures, timeout=max(member_deadline - monotonic(), 0))
+
+    # Slow members are dropped rather than waited for. A member already calling the serving runtime stops at its timeout,
+    #  but a local member runs to the end, holding one of the ENSEMBLE_LOCAL_THREADS until it does.
+    for future in not_done:
+        future.cancel()
+
+    if rejected:
+        print(f"Submodels {', '.join(rejected)} were left out of the ensemble, since every local thread was busy.")
+    results = MemberResults(dict(), [futures[future] for future in not_done], dict(), rejected)
+    for future in done:
+        if future.exception() is not None:
+            print(f"Submodel {futures[future]} failed and was left out of the ensemble.")
+            print_exception(future.exception())
+            results.failed[futures[future]] = future.exception()
+            continue
+        results.predictions[futures[future]] = future.result()
+    return results
@@ -0,0 +1,90 @@
+from gc import collect, freeze, unfreeze
+from os import getenv, getpid, kill
+from signal import SIGHUP
+from threading import Thread, Timer
+from time import monotonic, sleep
+
+from common import CACHE_TTL, available_cores
+from common.model_factory import freeze_models, frozen_models_outdated
+
+# Serves the app with several workers that share one copy of the models: gunicorn -c gunicorn.conf.py app:app
+#  The master loads the models and then forks the workers, so they share the memory the models live in copy-on-write.
+#  Reloading the models (on /reload_models, or when the Active runs change, checked every CACHE_TTL seconds) is done once in the master,
+#  which then replaces all of its workers with ones that share the new models.
+bind = "0.0.0.0:8000"
+workers = int(getenv("SERVING_WORKERS") or available_cores())
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+raw_env = ["SERVING_PREFORK=true"]
+
+# Reload requests that arrive within this many seconds of the end of the last reload are put off until then, and all
+#  of them are served by that one reload. A burst of /reload_models calls loads the models and replaces the workers
+#  at most twice, and the last call is never lost.
+MIN_RELOAD_INTERVAL_SECONDS = float(getenv("MIN_RELOAD_INTERVAL_SECONDS") or min(10, CACHE_TTL / 2))
+
+
+def _load_shared_models(server):
+    # The previous models were frozen along with everything else, so the collector could never free them once replaced.
+    unfreeze()
+    collect()
+    try:
+        freeze_models()
+    except Exception:
+        # The workers keep serving the models they already have. An unhandled error here would stop the master for good.
+        server.log.exception("Failed to load the models. The previous models, if any, are kept.")
+    # Moves everything loaded so far out of the reach of the garbage collector. Otherwise, the collector in each worker
+    #  would write to (and so copy) every page holding the models the first time it runs.
+    collect()
+    freeze()
+
+
+def _reload_periodically(server):
+    # Replacing every worker is expensive, so this only reloads when the Active runs or their traffic have changed.
+    while True:
+        sleep(CACHE_TTL)
+        try:
+            outdated = frozen_models_outdated()
+        except Exception:
+            server.log.exception("Failed to check whether the models have changed.")
+            continue
+        if outdated:
+            kill(getpid(), SIGHUP)
+
+
+def _coalesce_reloads(server):
+    # The config file is read again on every reload, so the time of the last one is kept by the wrapper rather than in this module.
+    handle_hup = server.handle_hup
+    last_reload = [monotonic()]
+    deferred_reload = [None]
+
+    def reload_later():
+        # Cleared before signalling, so that the signal is never mistaken for one that is already deferred.
+        deferred_reload[0] = None
+        kill(getpid(), SIGHUP)
+
+    def handle_hup_coalesced():
+        wait = last_reload[0] + MIN_RELOAD_INTERVAL_SECONDS - monotonic()
+        if wait > 0:
+            if deferred_reload[0] is None:
+                server.log.info("Deferring a reload for %.1f seconds, since the last one was too recent.", wait)
+                deferred_reload[0] = Timer(wait, reload_later)
+                deferred_reload[0].daemon = True
+                deferred_reload[0].start()
+            return
+        if deferred_reload[0] is not None:
+            deferred_reload[0].cancel()
+            deferred_reload[0] = None
+        handle_hup()
+        last_reload[0] = monotonic()
+
+    server.handle_hup = handle_hup_coalesced
+
+
+def when_ready(server):
+    _load_shared_models(server)
+    _coalesce_reloads(server)
+    Thread(target=_reload_periodically, args=(server,), daemon=True).start()
+
+
+def on_reload(server):
+    _load_shared_models(server)
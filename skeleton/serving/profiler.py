@@ -0,0 +1,46 @@
+from collections import Counter
+from sys import _current_frames
+from threading import enumerate as enumerate_threads, get_ident
+from time import monotonic, sleep
+from types import FrameType
+from typing import Dict
+
+# A sampling profiler for the live process. It adds no overhead while it isn't running, so it is safe to use in production.
+#  The result is in the collapsed stack format, which flamegraph.pl, speedscope and most other flame graph viewers read.
+
+
+def _collapse_stack(thread_name: str, frame: FrameType) -> str:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+        frame = frame.f_back
+    stack.append(thread_name)
+    return ";".join(reversed(stack))
+
+
+def sample_stacks(seconds: float, interval: float) -> Dict[str, int]:
+    """
+    Samples the stack of every other thread in the process at a fixed interval.
+
+    Args:
+        seconds (float): How long to profile for.
+        interval (float): Seconds between samples.
+
+    Returns:
+        How many times each stack was seen, by collapsed stack.
+    """
+    own_thread = get_ident()
+    counts = Counter()
+    end = monotonic() + seconds
+    while monotonic() < end:
+        thread_names = {thread.ident: thread.name for thread in enumerate_threads()}
+        for thread_id, frame in _current_frames().items():
+            if thread_id != own_thread:
+                counts[_collapse_stack(thread_names.get(thread_id, str(thread_id)), frame)] += 1
+        sleep(interval)
+    return counts
+
+
+def to_collapsed(counts: Dict[str, int]) -> str:
+    return "\n".join(f"{stack} {count}" for stack, count in sorted(counts.items())) + "\n"
@@ -0,0 +1,97 @@
+from asyncio import gather, run, sleep
+from time import monotonic
+from types import SimpleNamespace
+from unittest import TestCase, main
+
+from fastapi import HTTPException
+
+from admission import DEADLINE_HEADER, MAX_REQUEST_TIMEOUT_MS, AdmissionController, _request_deadline
+
+
+class TestAdmissionController(TestCase):
+    def test_rejects_when_queue_is_full(self):
+        async def scenario():
+            controller = AdmissionController(max_in_flight=1, max_queued=1)
+
+            async def hold():
+                async with controller.admit(monotonic() + 1):
+                    await sleep(0.1)
+
+            async def late_request():
+                await sleep(0.01)
+                async with controller.admit(monotonic() + 1):
+                    pass
+
+            return await gather(hold(), hold(), late_request(), return_exceptions=True)
+
+        results = run(scenario())
+        self.assertIsNone(results[0])
+        self.assertIsNone(results[1])
+        self.assertIsInstance(results[2], HTTPException)
+        self.assertEqual(results[2].status_code, 429)
+
+    def test_rejects_when_deadline_passes_in_queue(self):
+        async def scenario():
+            controller = AdmissionController(max_in_flight=1, max_queued=1)
+
+            async def hold():
+                async with controller.admit(monotonic() + 1):
+                    await sleep(0.2)
+
+            async def impatient_request():
+                await sleep(0.01)
+                async with controller.admit(monotonic() + 0.05):
+                    pass
+
+            return await gather(hold(), impatient_request(), return_exceptions=True)
+
+        results = run(scenario())
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], HTTPException)
+        self.assertEqual(results[1].status_code, 503)
+
+    def test_rejects_up_front_when_queue_is_too_slow(self):
+        async def scenario():
+            controller = AdmissionController(max_in_flight=1, max_queued=4)
+
+            async def hold():
+                async with controller.admit(monotonic() + 1):
+                    await sleep(0.1)
+
+            async def queued_request(timeout: float) -> float:
+                await sleep(0.01)
+                start = monotonic()
+                try:
+                    async with controller.admit(monotonic() + timeout):
+                        pass
+                finally:
+                    waited.append(monotonic() - start)
+
+            waited = []
+            await hold()  # Teaches the controller that requests take about 0.1 seconds.
+            results = await gather(hold(), queued_request(0.05), queued_request(1), return_exceptions=True)
+            return results, waited
+
+        results, waited = run(scenario())
+        self.assertIsInstance(results[1], HTTPException)
+        self.assertEqual(results[1].status_code, 503)
+        # The impatient request is turned away without waiting for its deadline, and the patient one is still served.
+        self.assertLess(waited[0], 0.02)
+        self.assertIsNone(results[2])
+
+
+
+class TestRequestDeadline(TestCase):
+    def test_rejects_invalid_timeouts(self):
+        for timeout_ms in ["abc", "nan", "inf", "-5", "0"]:
+            with self.assertRaises(HTTPException) as context:
+                _request_deadline(SimpleNamespace(headers={DEADLINE_HEADER: timeout_ms}))
+            self.assertEqual(context.exception.status_code, 400)
+
+    def test_caps_timeout(self):
+        deadline = _request_deadline(SimpleNamespace(headers={DEADLINE_HEADER: str(MAX_REQUEST_TIMEOUT_MS * 10)}))
+        self.assertLessEqual(deadline, monotonic() + MAX_REQUEST_TIMEOUT_MS / 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+from asyncio import Event, create_task, run, sleep
+from signal import SIGHUP
+from time import monotonic
+from unittest import TestCase, main
+from unittest.mock import Mock, patch
+
+from fastapi import HTTPException, Response
+
+import app
+from contract import Contract
+
+
+class TestRefreshModelsPeriodically(TestCase):
+    def refresh_calls(self, refresh: Mock, request_reload: bool) -> int:
+        async def scenario():
+            reload_requested = Event()
+            task = create_task(app.refresh_models_periodically(reload_requested))
+            await sleep(0.05)
+            if request_reload:
+                reload_requested.set()
+                await sleep(0.05)
+            task.cancel()
+
+        with patch.object(app, "refresh_models", refresh), \
+                patch.object(app, "MODEL_REFRESH_SECONDS", 60), \
+                patch.object(app, "MODEL_RETRY_SECONDS", 60):
+            run(scenario())
+        return refresh.call_count
+
+    def test_loads_at_start(self):
+        self.assertEqual(self.refresh_calls(Mock(return_value={"run": None}), request_reload=False), 1)
+
+    def test_reloads_when_requested(self):
+        self.assertEqual(self.refresh_calls(Mock(return_value={"run": None}), request_reload=True), 2)
+
+    def test_survives_failed_loads(self):
+        self.assertEqual(self.refresh_calls(Mock(side_effect=RuntimeError("MLflow is down")), request_reload=True), 2)
+
+    def test_retries_sooner_without_models(self):
+        refresh = Mock(return_value={})
+
+        async def scenario():
+            task = create_task(app.refresh_models_periodically(Event()))
+            await sleep(0.1)
+            task.cancel()
+
+        with patch.object(app, "refresh_models", refresh), \
+                patch.object(app, "MODEL_REFRESH_SECONDS", 60), \
+                patch.object(app, "MODEL_RETRY_SECONDS", 0.01):
+            run(scenario())
+        self.assertGreater(refresh.call_count, 2)
+
+
+class TestReadiness(TestCase):
+    def test_not_ready_without_models(self):
+        response = Response()
+        load_state = {"loaded_at": None, "error": "No active models were found."}
+        with patch.object(app, "peek_active_models", return_value=None), patch.object(app, "get_model_load_state", return_value=load_state):
+            body = run(app.readiness(response))
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(body, {"ready": False, "models_age_seconds": None, "last_error": "No active models were found."})
+
+    def test_ready_with_models(self):
+        response = Response()
+        load_state = {"loaded_at": 0., "error": None}
+        with patch.object(app, "peek_active_models", return_value={"run": None}), patch.object(app, "get_model_load_state", return_value=load_state):
+            body = run(app.readiness(response))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(body["ready"])
+
+
+class TestReloadModels(TestCase):
+    def test_wakes_the_refresh(self):
+        app.app.state.reload_requested = Event()
+        with patch.object(app, "SERVING_PREFORK", False):
+            self.assertTrue(run(app.reload_models()))
+        self.assertTrue(app.app.state.reload_requested.is_set())
+
+    def test_signals_the_master_when_prefork(self):
+        with patch.object(app, "SERVING_PREFORK", True), patch.object(app, "getppid", return_value=1234), patch.object(app, "kill") as kill:
+            self.assertTrue(run(app.reload_models()))
+        kill.assert_called_once_with(1234, SIGHUP)
+
+
+class TestPredict(TestCase):
+    def test_unavailable_without_models(self):
+        with patch.object(app, "peek_active_models", return_value=None):
+            with self.assertRaises(HTTPException) as raised:
+                app.predict(Contract(), monotonic() + 1)
+
+        self.assertEqual(raised.exception.status_code, 503)
+        self.assertIn("Retry-After", raised.exception.headers)
+
+
+if __name__ == '__main__':
+    main()
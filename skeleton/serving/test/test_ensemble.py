@@ -0,0 +1,61 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+from time import monotonic, sleep
+from unittest import TestCase, main
+from unittest.mock import patch
+
+from pandas import DataFrame
+
+from ensemble import predict_members
+
+
+def fake_member(data: DataFrame, model_data, deadline: float):
+    delay, prediction = model_data
+    sleep(delay)
+    if isinstance(prediction, Exception):
+        raise prediction
+    return prediction
+
+
+@patch("ensemble._predict_member", fake_member)
+class TestPredictMembers(TestCase):
+    def test_drops_slow_members(self):
+        start = monotonic()
+        results = predict_members(DataFrame([{}]), {"fast": (0., 1.), "slow": (0.5, 2.)}, monotonic() + 0.1)
+
+        self.assertLess(monotonic() - start, 0.4)
+        self.assertEqual(results.predictions, {"fast": 1.})
+        self.assertEqual(results.timed_out, ["slow"])
+        self.assertEqual(results.failed, {})
+
+    def test_separates_failed_members(self):
+        error = ValueError("broken")
+        results = predict_members(DataFrame([{}]), {"fast": (0., 1.), "broken": (0., error)}, monotonic() + 0.1)
+
+        self.assertEqual(results.predictions, {"fast": 1.})
+        self.assertEqual(results.timed_out, [])
+        self.assertEqual(results.failed, {"broken": error})
+
+    def test_rejects_local_members_when_busy(self):
+        # The members are local, since get_model finds their delay where it expects the model.
+        with patch("ensemble._local_executor", ThreadPoolExecutor(max_workers=1)), patch("ensemble._local_slots", BoundedSemaphore(1)):
+            first = predict_members(DataFrame([{}]), {"slow": (0.5, 2.)}, monotonic() + 0.05)
+            # The slow member of the first request still holds the only local thread, so concurrent requests are
+            #  turned away at once rather than queued behind it.
+            start = monotonic()
+            with ThreadPoolExecutor(max_workers=3) as requests:
+                busy = list(requests.map(lambda _: predict_members(DataFrame([{}]), {"slow": (0.5, 2.)}, monotonic() + 1), range(3)))
+            self.assertLess(monotonic() - start, 0.1)
+            sleep(0.5)
+            after = predict_members(DataFrame([{}]), {"fast": (0., 1.)}, monotonic() + 0.1)
+
+        self.assertEqual(first.timed_out, ["slow"])
+        for results in busy:
+            self.assertEqual(results.rejected, ["slow"])
+            self.assertEqual(results.predictions, {})
+        self.assertEqual(after.predictions, {"fast": 1.})
+        self.assertEqual(after.rejected, [])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+from threading import Event, Thread
+from unittest import TestCase, main
+
+from profiler import sample_stacks, to_collapsed
+
+
+def busy_wait(stop: Event):
+    while not stop.is_set():
+        stop.wait(0.001)
+
+
+class TestProfiler(TestCase):
+    def test_samples_other_threads(self):
+        stop = Event()
+        thread = Thread(target=busy_wait, args=(stop,), name="busy")
+        thread.start()
+        try:
+            counts = sample_stacks(0.1, 0.005)
+        finally:
+            stop.set()
+            thread.join()
+
+        busy_stacks = [stack for stack in counts if stack.startswith("busy;")]
+        self.assertTrue(busy_stacks)
+        self.assertTrue(any("busy_wait" in stack for stack in busy_stacks))
+        self.assertIn(f"{busy_stacks[0]} {counts[busy_stacks[0]]}", to_collapsed(counts).splitlines())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,138 @@
-from common.transformations import preprocess
-from common.model_factory import new_model, save_model
+from concurrent.futures import ProcessPoolExecutor
+from logging import INFO, basicConfig, getLogger
+from multiprocessing import get_context
+from os import getenv
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+from common import _strtobool, available_cores
+from common.pipeline import Pipeline, measure_pipeline
+from common.transformations import new_pipeline, preprocess
+from common.model_factory import (
+    new_model,
+    save_model,
+    start_search_run,
+    log_search_result,
+    load_active_run,
+    load_run_model,
+    load_run_pipeline
+)
 from numpy.random import seed
-from sklearn.model_selection import train_test_split
-from training.load_data import load_data
+from pandas import DataFrame, Series, isna
+from sklearn.ensemble import HistGradientBoostingClassifier, HistGradientBoostingRegressor
+from sklearn.model_selection import ParameterGrid, train_test_split
+from training.load_data import WATERMARK_COLUMN, load_data, get_data_watermark
+
+logger = getLogger(__name__)
+
+# Continue training the current Active model on the data that arrived since it was trained, instead of starting from scratch.
+INCREMENTAL_TRAINING = _strtobool(getenv("INCREMENTAL_TRAINING") or "False")
+# How many trees (or boosting iterations) an ensemble adds when it is trained incrementally with warm_start.
+INCREMENTAL_ESTIMATORS = int(getenv("INCREMENTAL_ESTIMATORS") or 10)
+
+# To train several candidates at once (e.g. for an A/B test), list them here as (submodel_name, model_config) pairs.
+#  model_config is passed to new_model as keyword arguments, and a submodel_name of None uses the name of the experiment.
+#  build_model_configs can expand a hyperparameter grid into this format.
+#  Every candidate is scored on the held-out split with its score method (higher is better), and the runs are nested under
+#  one run for the search, which records the best of them. Promoting a candidate is still up to you.
+#  If this is empty, a single model is trained with the default configuration.
+MODEL_CONFIGS: Sequence[Tuple[Optional[str], Dict[str, Any]]] = []
+
+# Set by the parent process before the pool is forked so that every worker reads the same split without it being pickled or copied.
+_shared_training_data: Optional[Tuple[DataFrame, Series, DataFrame, Series, Dict[str, str], Optional[Pipeline], Dict[str, float], str]] = None
+
+
+def build_model_configs(param_grid: Union[Dict[str, Sequence], Sequence[Dict[str, Sequence]]],
+                        submodel_name: Optional[str] = None) -> List[Tuple[Optional[str], Dict[str, Any]]]:
+    """
+    Expands a hyperparameter grid into (submodel_name, model_config) pairs for MODEL_CONFIGS.
+
+    Args:
+        param_grid (Union[Dict[str, Sequence], Sequence[Dict[str, Sequence]]]): The hyperparameter values to try, in the format of sklearn's ParameterGrid.
+        submodel_name (Optional[str]): Submodel name to save every configuration under. If not provided, uses the name of the experiment.
+    """
+    return [(submodel_name, model_config) for model_config in ParameterGrid(param_grid)]
+
+
+def _watermark_metadata(data: DataFrame) -> Dict[str, str]:
+    watermark = get_data_watermark(data)
+    if watermark is None:
+        return {}
+    return {"data_watermark": watermark}
+
+
+def fit_pipeline(preprocessed_data: DataFrame) -> Tuple[DataFrame, Optional[Pipeline], Dict[str, float]]:
+    """
+    Fits the pipeline from common.transformations.new_pipeline, if there is one, and applies it.
+
+    Args:
+        preprocessed_data (DataFrame): The training data, after preprocess.
+
+    Returns:
+        The features to train on, the fitted pipeline, and its cost per row to save with the model.
+    """
+    pipeline = new_pipeline()
+    if pipeline is None:
+        return preprocessed_data, None, {}
+    pipeline.fit(preprocessed_data)
+    return pipeline.transform_frame(preprocessed_data), pipeline, measure_pipeline(pipeline, preprocessed_data)
+
+
+def _train_candidate(candidate: Tuple[Optional[str], Dict[str, Any]]) -> Tuple[str, float]:
+    submodel_name, model_config = candidate
+    x_train, y_train, x_validation, y_validation, extra_immutable_metadata, pipeline, pipeline_metrics, search_run_id = _shared_training_data
+
+    seed(1)  # Each worker is seeded the same way as a single training run for repeatability.
+    model = new_model(**model_config)
+    model.fit(x_train, y_train, random_state=1)
+    score = float(model.score(x_validation, y_validation))
+
+    immutable_metadata = {**extra_immutable_metadata, **{"config_" + name: str(value) for name, value in model_config.items()}}
+    run_id = save_model(model, submodel_name, immutable_metadata, x_train, pipeline,
+                        {**pipeline_metrics, "validation_score": score}, search_run_id)
+    return run_id, score
+
+
+def train_candidates(candidates: Sequence[Tuple[Optional[str], Dict[str, Any]]],
+                     x_train: DataFrame,
+                     y_train: Series,
+                     x_validation: DataFrame,
+                     y_validation: Series,
+                     immutable_metadata: Dict[str, str] = {},
+                     pipeline: Optional[Pipeline] = None,
+                     pipeline_metrics: Dict[str, float] = {}) -> Tuple[str, float]:
+    """
+    Trains several model configurations in parallel and saves each one as its own run, nested under a run for the search.
+
+    Args:
+        candidates (Sequence[Tuple[Optional[str], Dict[str, Any]]]): The (submodel_name, model_config) pairs to train.
+        x_train (DataFrame): The preprocessed training data, shared by every candidate.
+        y_train (Series): The training target, shared by every candidate.
+        x_validation (DataFrame): The preprocessed data every candidate is scored on, which it isn't trained on.
+        y_validation (Series): The target of the validation data.
+        immutable_metadata (Dict[str, str]): Metadata to save with every candidate on top of its configuration.
+        pipeline (Optional[Pipeline]): The fitted pipeline that produced x_train, saved with every candidate.
+        pipeline_metrics (Dict[str, float]): The cost of the pipeline, saved with every candidate.
+
+    Returns:
+        The run id and validation score of the best candidate.
+    """
+    global _shared_training_data
+    search_run_id = start_search_run(immutable_metadata)
+    _shared_training_data = (x_train, y_train, x_validation, y_validation, immutable_metadata, pipeline, pipeline_metrics, search_run_id)
+
+    # Forking (rather than spawning) hands the split to the workers copy-on-write.
+    n_workers = min(len(candidates), available_cores())
+    results = []
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context("fork")) as executor:
+        for (submodel_name, model_config), (run_id, score) in zip(candidates, executor.map(_train_candidate, candidates)):
+            logger.info("Saved submodel %s with configuration %s as run %s, with a validation score of %s.",
+                        submodel_name or "default", model_config, run_id, score)
+            results.append((run_id, score))
+
+    best_run_id, best_score = max(results, key=lambda result: result[1])
+    log_search_result(search_run_id, best_run_id, best_score)
+    logger.info("The best candidate of search run %s is run %s, with a validation score of %s.", search_run_id, best_run_id, best_score)
+    return best_run_id, best_score
 
 
 def main():
@@ -10,17 +140,97 @@ def main():
 
     seed(1)  # Put a seed in here for repeatability.
     target_column = 'target'
-    x_train, x_test, y_train, y_test = train_test_split(data.drop([target_column], axis=1), data[target_column])
-    
-    preprocessed_data = preprocess(x_train)
-    
+    # The watermark only orders the data. As a feature, it would always be outside the training range when serving.
+    features = data.drop([target_column], axis=1).drop(columns=[WATERMARK_COLUMN], errors="ignore")
+    x_train, x_test, y_train, y_test = train_test_split(features, data[target_column])
+
+    preprocessed_data, pipeline, pipeline_metrics = fit_pipeline(preprocess(x_train))
+
+    if MODEL_CONFIGS:
+        validation_data = preprocess(x_test)
+        if pipeline is not None:
+            validation_data = pipeline.transform_frame(validation_data)
+        train_candidates(MODEL_CONFIGS, preprocessed_data, y_train, validation_data, y_test, _watermark_metadata(data), pipeline, pipeline_metrics)
+        return
+
     model = new_model()
     model.fit(preprocessed_data, y_train, random_state=1)  # Put a seed in here for repeatability.
     #  Note that some models may not accept this parameter.
 
     # Add your evaluation metric here if you need to immediately see how the model performed on the test set.
-    save_model(model)
+    save_model(model, immutable_metadata=_watermark_metadata(data), sample_data=preprocessed_data,
+               pipeline=pipeline, mutable_metadata=pipeline_metrics)
+
+
+def continue_training(model, x_train: DataFrame, y_train: Series):
+    """
+    Updates an already fitted model with new data rather than refitting it.
+
+    Args:
+        model: The fitted model, loaded with its native mlflow flavor.
+        x_train (DataFrame): The preprocessed new data.
+        y_train (Series): The target for the new data.
+    """
+    if hasattr(model, "partial_fit"):
+        model.partial_fit(x_train, y_train)
+    elif hasattr(model, "get_params") and "warm_start" in model.get_params():
+        # Ensembles only fit new members on the new data if they are allowed more members than they already have.
+        #  Otherwise, fit does nothing and the parent model would be saved again as if it had seen the new data.
+        params = model.get_params()
+        if isinstance(model, (HistGradientBoostingClassifier, HistGradientBoostingRegressor)):
+            model.set_params(max_iter=params["max_iter"] + INCREMENTAL_ESTIMATORS)
+        elif "n_estimators" in params:
+            model.set_params(n_estimators=params["n_estimators"] + INCREMENTAL_ESTIMATORS)
+        model.set_params(warm_start=True)
+        model.fit(x_train, y_train)
+    else:
+        raise ValueError("The model supports neither partial_fit nor warm_start, so it cannot be trained incrementally. "
+                         "If it does, set _mlflow_flavor in common.model_factory so that it is loaded with its native flavor.")
+    return model
+
+
+def main_incremental():
+    parent_run = load_active_run()
+    parent_watermark = None if parent_run is None else parent_run.get("params.data_watermark")
+    if parent_watermark is None or isna(parent_watermark):
+        logger.info("No Active run with a data watermark was found. Training from scratch instead.")
+        main()
+        return
+
+    data = load_data(since=parent_watermark)
+    if data.empty:
+        logger.info("No new data since %s. Nothing to train.", parent_watermark)
+        return
+
+    seed(1)  # Put a seed in here for repeatability.
+    target_column = 'target'
+    # Every new row is trained on, since the watermark moves past all of them and the next run never loads them again.
+    #  Evaluate the new model on data it hasn't seen before promoting it instead.
+    # The watermark only orders the data. As a feature, it would always be outside the training range when serving.
+    x_train = data.drop([target_column], axis=1).drop(columns=[WATERMARK_COLUMN], errors="ignore")
+    y_train = data[target_column]
+
+    preprocessed_data = preprocess(x_train)
+    # The model keeps the features it was trained with, so the parent's pipeline is reused rather than refitted.
+    pipeline = load_run_pipeline(parent_run)
+    pipeline_metrics = dict()
+    if pipeline is not None:
+        pipeline_metrics = measure_pipeline(pipeline, preprocessed_data)
+        preprocessed_data = pipeline.transform_frame(preprocessed_data)
+
+    model = continue_training(load_run_model(parent_run), preprocessed_data, y_train)
+
+    immutable_metadata = {
+        **_watermark_metadata(data),
+        "parent_run_id": parent_run.run_id,
+        "parent_data_watermark": parent_watermark
+    }
+    save_model(model, parent_run["params.submodel_name"], immutable_metadata, preprocessed_data, pipeline, pipeline_metrics)
 
 
 if __name__ == "__main__":
-    main()
+    basicConfig(level=INFO)
+    if INCREMENTAL_TRAINING:
+        main_incremental()
+    else:
+        main()
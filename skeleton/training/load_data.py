@@ -1,6 +1,18 @@
 from pandas import DataFrame
+from typing import Optional
 
+# The column that orders your data by arrival, e.g. an ingestion timestamp or an increasing id.
+WATERMARK_COLUMN = 'timestamp'
 
-def load_data() -> DataFrame:
+
+def load_data(since: Optional[str] = None) -> DataFrame:
+    # If since is set, only load the data that arrived after that watermark (as returned by get_data_watermark).
+    #  This is what lets incremental training scale with the amount of new data instead of the full history.
     data = DataFrame()
     return data
+
+
+def get_data_watermark(data: DataFrame) -> Optional[str]:
+    if data.empty or WATERMARK_COLUMN not in data.columns:
+        return None
+    return str(data[WATERMARK_COLUMN].max())
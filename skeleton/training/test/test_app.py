@@ -0,0 +1,117 @@
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main
+from unittest.mock import patch
+
+import mlflow
+import mlflow.sklearn
+import numpy as np
+from pandas import DataFrame, Series
+from sklearn.ensemble import HistGradientBoostingRegressor, RandomForestRegressor
+from sklearn.linear_model import Ridge, SGDRegressor
+
+from common import MODEL_NAME, model_factory
+from training import app
+from training.app import INCREMENTAL_ESTIMATORS, continue_training, main_incremental, train_candidates
+
+
+def build_data(rows: int = 40, start: int = 0) -> DataFrame:
+    rng = np.random.default_rng(start)
+    x = rng.normal(size=rows)
+    return DataFrame({"timestamp": np.arange(start, start + rows), "x": x, "target": 2 * x})
+
+
+class CandidateRidge(Ridge):
+    # Training passes a random_state to fit, which Ridge doesn't take.
+    def fit(self, x, y, random_state=None):
+        return super().fit(x, y)
+
+
+class TestContinueTraining(TestCase):
+    def test_forest_grows(self):
+        data = build_data()
+        model = RandomForestRegressor(n_estimators=5, random_state=1).fit(data[["x"]], data["target"])
+        new_data = build_data(start=40)
+        continue_training(model, new_data[["x"]], new_data["target"])
+        self.assertEqual(len(model.estimators_), 5 + INCREMENTAL_ESTIMATORS)
+
+    def test_hist_gradient_boosting_grows(self):
+        data = build_data()
+        model = HistGradientBoostingRegressor(max_iter=5, early_stopping=False).fit(data[["x"]], data["target"])
+        new_data = build_data(start=40)
+        continue_training(model, new_data[["x"]], new_data["target"])
+        self.assertEqual(model.n_iter_, 5 + INCREMENTAL_ESTIMATORS)
+
+    def test_partial_fit(self):
+        data = build_data()
+        model = SGDRegressor(random_state=1).fit(data[["x"]], data["target"])
+        seen = model.t_
+        new_data = build_data(start=40)
+        continue_training(model, new_data[["x"]], new_data["target"])
+        self.assertEqual(model.t_, seen + len(new_data))
+
+    def test_unsupported_model(self):
+        data = build_data()
+        with self.assertRaises(ValueError):
+            continue_training(object(), data[["x"]], data["target"])
+
+
+class TestMainIncremental(TestCase):
+    def test_trains_on_every_new_row(self):
+        old_data = build_data()
+        new_data = build_data(start=40)
+        parent_model = SGDRegressor(random_state=1).fit(old_data[["x"]], old_data["target"])
+        parent_run = Series({"run_id": "parent", "params.data_watermark": "39", "params.submodel_name": None})
+        seen = parent_model.t_
+
+        with patch.object(app, "load_active_run", return_value=parent_run), \
+                patch.object(app, "load_data", return_value=new_data) as load_data, \
+                patch.object(app, "load_run_model", return_value=parent_model), \
+                patch.object(app, "load_run_pipeline", return_value=None), \
+                patch.object(app, "save_model") as save_model:
+            main_incremental()
+
+        load_data.assert_called_once_with(since="39")
+        model, submodel_name, immutable_metadata, sample_data, _, _ = save_model.call_args.args
+        # The watermark moves past every new row, so every one of them must have been trained on.
+        self.assertEqual(model.t_, seen + len(new_data))
+        self.assertEqual(len(sample_data), len(new_data))
+        self.assertEqual(immutable_metadata["data_watermark"], str(new_data["timestamp"].max()))
+        self.assertEqual(immutable_metadata["parent_run_id"], "parent")
+        self.assertEqual(immutable_metadata["parent_data_watermark"], "39")
+
+
+class TestTrainCandidates(TestCase):
+    def setUp(self):
+        self.tracking_dir = TemporaryDirectory()
+        self.addCleanup(self.tracking_dir.cleanup)
+        tracking_uri = mlflow.get_tracking_uri()
+        mlflow.set_tracking_uri("file://" + self.tracking_dir.name)
+        self.addCleanup(mlflow.set_tracking_uri, tracking_uri)
+
+    def test_saves_every_candidate_under_the_search(self):
+        data = build_data()
+        validation_data = build_data(start=40)
+        candidates = [("ridge", {"alpha": 0.01}), ("ridge", {"alpha": 1000.}), ("other", {"alpha": 1.})]
+
+        with patch.object(app, "new_model", lambda **model_config: CandidateRidge(**model_config)), \
+                patch.object(model_factory, "_mlflow_flavor", mlflow.sklearn):
+            best_run_id, best_score = train_candidates(candidates, data[["x"]], data["target"],
+                                                       validation_data[["x"]], validation_data["target"], {"data_watermark": "39"})
+
+        runs = mlflow.search_runs(experiment_names=[MODEL_NAME])
+        search_run = runs[runs["params.best_run_id"].notna()].iloc[0]
+        candidate_runs = runs[runs["tags.mlflow.parentRunId"] == search_run.run_id].set_index("params.config_alpha")
+        self.assertEqual(len(runs), len(candidates) + 1)
+        self.assertEqual(sorted(candidate_runs.index), ["0.01", "1.0", "1000.0"])
+        self.assertEqual(sorted(candidate_runs["params.submodel_name"]), ["other", "ridge", "ridge"])
+        self.assertTrue((candidate_runs["params.data_watermark"] == "39").all())
+
+        # The least regularised candidate fits the linear target best.
+        self.assertEqual(best_run_id, candidate_runs.loc["0.01", "run_id"])
+        self.assertEqual(search_run["params.best_run_id"], best_run_id)
+        self.assertAlmostEqual(search_run["metrics.best_validation_score"], best_score)
+        self.assertEqual(candidate_runs["metrics.validation_score"].max(), best_score)
+
+
+if __name__ == '__main__':
+    main()